@@ -0,0 +1,854 @@
+#-------------------------------------------------------------
+# Name:       Benchmark Export Web Map
+# Purpose:    Benchmarks the Export Web Map script without ArcGIS, using an in-memory stub of the arcpy.mapping
+#             functions the script uses and synthetic web maps. Reports the time for each stage and compares the
+#             results to a previous run to find regressions.
+#             e.g. python BenchmarkExportWebMap.py "Results.json" "BaselineResults.json"
+#             The batch pool throughput is measured with 1 to N worker processes against simulated arcpy time (poolStubCosts)
+#             Can also run the print service with the stub arcpy e.g. python BenchmarkExportWebMap.py service 8080
+# Author:     Shaun Weston (shaun_weston@eagle.co.nz)
+# Date Created:    17/10/2026
+# Last Updated:    17/10/2026
+# Copyright:   (c) Eagle Technology
+# ArcGIS Version:   Not needed
+# Python Version:   2.7+
+#--------------------------------
+
+# Import main modules
+import os
+import sys
+import time
+import json
+import copy
+import math
+import random
+import shutil
+import tempfile
+import types
+import uuid
+import collections
+import socket
+import threading
+import multiprocessing.pool
+# Python version check
+if sys.version_info[0] >= 3:
+    # Python 3.x
+    import http.server as BaseHTTPServer
+    import socketserver as SocketServer
+    import urllib.request as urllib2
+    from importlib import reload
+else:
+    # Python 2.x
+    import BaseHTTPServer
+    import SocketServer
+    import urllib2
+
+# Set global variables
+# Simulated time taken by the stub arcpy functions in seconds
+stubCosts = {"ConvertWebMapToMapDocument": 0.0, "MapDocument": 0.0, "saveACopy": 0.0, "adjustColumnCount": 0.0,
+             "ExportToPDF": 0.0, "ExportToPNG": 0.0, "ExportToJPEG": 0.0, "appendPages": 0.0}
+stubOutputBytes = 10000 # Size of the files created by the stub exports
+stubLegendItemHeight = 0.5 # Height of a legend item in the stub legend in cm
+# Benchmarks
+layerCounts = [10, 100, 250, 500, 1000] # Number of operational layers in the synthetic web maps
+legendItemCounts = [25, 100, 500, 2000, 5000] # Number of legend items for the legend column fitting benchmark
+benchmarkRuns = 5 # Number of times each benchmark is run - The fastest run is reported
+atlasPages = 20 # Number of extents for the atlas benchmark
+stressJobs = 60 # Number of jobs for the concurrency benchmark
+stressThreads = 8 # Number of threads exporting the jobs at the same time
+tileCount = 50 # Number of tiles for the tile cache benchmark
+tileServerDelay = 0.05 # Seconds the stand-in tile server takes to return a tile
+tileBytes = 20000 # Size of the tiles returned by the stand-in tile server
+emailErrors = 200 # Number of errors for the error email benchmark
+emailUniqueErrors = 5 # Number of different errors in the error email benchmark - The rest are repeats
+emailErrorInterval = 0.005 # Seconds between the errors in the error email benchmark
+emailDigestInterval = 0.2 # Minimum seconds between emails for the error email benchmark
+emailServerDelay = 0.1 # Seconds the stand-in email server takes to accept an email
+poolWorkerCounts = [1, 2, 4] # Number of worker processes for the batch pool throughput benchmark
+poolJobs = 24 # Number of batch jobs for each worker count
+poolStubCosts = {"ConvertWebMapToMapDocument": 0.05, "ExportToPDF": 0.05} # Simulated arcpy time for the batch pool throughput benchmark - Most of the time of a real export is in arcpy
+regressionThreshold = 0.2 # Fraction slower than the baseline before a result is a regression
+higherIsBetterResults = ["tileCache.hits", "tileCache.revalidated", "tileCache.collapsed", "tileCache.bytesSaved", "tileCache.hitRatio"] \
+                        + ["pool." + name + "." + str(workerCount) for workerCount in poolWorkerCounts for name in ["jobsPerSecond","scaling"]] # Results that are a regression when lower than the baseline
+regressionMinimum = 0.001 # Smallest increase from the baseline that is a regression - Stops very fast stages being reported from timer noise
+stubCalls = collections.Counter()
+stubDocuments = {}
+
+
+# Start of main function
+def mainFunction(resultsFile,baselineFile): # Get parameters from ArcGIS Desktop tool by seperating by comma e.g. (var1 is 1st parameter,var2 is 2nd parameter,var3 is 3rd parameter)
+    exportWebMap = importExportWebMap()
+    templatesFolder = createStubTemplates()
+    try:
+        results = collections.OrderedDict()
+        results.update(benchmarkStages(exportWebMap,templatesFolder))
+        results.update(benchmarkLayerReconciliation(exportWebMap,templatesFolder))
+        results.update(benchmarkLegendFitting(exportWebMap))
+        results.update(benchmarkAtlas(exportWebMap,templatesFolder))
+        results.update(benchmarkTileCache(exportWebMap))
+        results.update(benchmarkConcurrency(exportWebMap,templatesFolder))
+        results.update(benchmarkPool(exportWebMap,templatesFolder))
+        results.update(benchmarkErrorEmail(exportWebMap))
+
+        # Print the results
+        for name in results:
+            print(name + ": " + str(results[name]))
+        # Write the results
+        if (resultsFile):
+            with open(resultsFile, "w") as resultsOutput:
+                json.dump(results, resultsOutput, indent=2)
+        # Compare the results to the baseline
+        if (baselineFile):
+            with open(baselineFile) as baselineContent:
+                regressions = compareResults(results, json.load(baselineContent))
+            for regression in regressions:
+                print("REGRESSION - " + regression)
+            return len(regressions) + results["concurrency.mismatches"] + results["concurrency.sharedOutputs"] + results["errorEmail.lostErrors"]
+        return results["concurrency.mismatches"] + results["concurrency.sharedOutputs"] + results["errorEmail.lostErrors"]
+    finally:
+        shutil.rmtree(templatesFolder, True)
+        shutil.rmtree(stubArcpy.env.scratchFolder, True)
+# End of main function
+
+
+# Start of service function
+def serviceFunction(servicePort): # Run the print service with the stub arcpy e.g. BenchmarkExportWebMap.py service 8080
+    exportWebMap = importExportWebMap()
+    templatesFolder = createStubTemplates()
+    if (servicePort):
+        exportWebMap.servicePort = int(servicePort)
+    # Worker processes only have the stub arcpy if they are forked from this process, so use worker threads on Windows
+    if (os.name == "nt"):
+        exportWebMap.batchThreads = "true"
+    try:
+        # Layout templates are the stub templates e.g. "A4 Landscape" or "Dynamic Legend/A4 Landscape"
+        exportWebMap.serviceFunction("", templatesFolder)
+    finally:
+        shutil.rmtree(templatesFolder, True)
+        shutil.rmtree(stubArcpy.env.scratchFolder, True)
+# End of service function
+
+
+# Start of benchmark stages function
+def benchmarkStages(exportWebMap,templatesFolder):
+    # Time each stage of exporting synthetic web maps of different sizes
+    results = collections.OrderedDict()
+    exportWebMap.enableMetrics = "true"
+    templateMxd = os.path.join(templatesFolder, "Dynamic Legend", "A4 Landscape.mxd")
+    for layerCount in layerCounts:
+        webmapJSON = json.dumps(createWebMap(layerCount))
+        stageTimes = {}
+        for run in range(benchmarkRuns):
+            jobContext = exportWebMap.createJobContext(templateMxd,"pdf")
+            exportWebMap.exportWebMap(webmapJSON,"",templateMxd,"pdf",[],jobContext)
+            # Keep the fastest time for each stage
+            for stage in jobContext["metrics"]["stages"]:
+                stageTimes[stage] = min(stageTimes.get(stage, float("inf")), jobContext["metrics"]["stages"][stage])
+        for stage in sorted(stageTimes):
+            results["stage." + stage + "." + str(layerCount)] = round(stageTimes[stage], 6)
+    exportWebMap.enableMetrics = "false"
+    return results
+# End of benchmark stages function
+
+
+# Start of benchmark layer reconciliation function
+def benchmarkLayerReconciliation(exportWebMap,templatesFolder):
+    # Time the layer and legend reconciliation on its own as the number of layers grows
+    results = collections.OrderedDict()
+    templateMxd = os.path.join(templatesFolder, "A4 Landscape.mxd")
+    for layerCount in layerCounts:
+        webmapJSON = json.dumps(createWebMap(layerCount))
+        bestTime = None
+        for run in range(benchmarkRuns):
+            mxd = stubMapping.ConvertWebMapToMapDocument(webmapJSON, templateMxd).mapDocument
+            legend = stubMapping.ListLayoutElements(mxd, "LEGEND_ELEMENT")[0]
+            startTime = time.time()
+            exportWebMap.reconcileLayers(mxd,mxd.dataFrames[0],legend)
+            runTime = time.time() - startTime
+            bestTime = runTime if (bestTime is None) else min(bestTime, runTime)
+            os.remove(mxd.filePath)
+        results["reconcileLayers." + str(layerCount)] = round(bestTime, 6)
+    return results
+# End of benchmark layer reconciliation function
+
+
+# Start of benchmark legend fitting function
+def benchmarkLegendFitting(exportWebMap):
+    # Count the legend re-layouts needed to fit legends of different sizes on a page
+    results = collections.OrderedDict()
+    for legendItemCount in legendItemCounts:
+        mxd = StubMapDocument("A4 Landscape", "Dynamic Legend")
+        for index in range(legendItemCount):
+            mxd.addLayer(StubLayer("Layer " + str(index), True))
+        legend = mxd.legend
+        stubCalls["adjustColumnCount"] = 0
+        startTime = time.time()
+        legendPages = exportWebMap.fitLegendColumns(legend,mxd.pageSize.height)
+        results["fitLegendColumns." + str(legendItemCount)] = round(time.time() - startTime, 6)
+        results["fitLegendColumns.relayouts." + str(legendItemCount)] = stubCalls["adjustColumnCount"]
+        results["fitLegendColumns.pages." + str(legendItemCount)] = legendPages
+    return results
+# End of benchmark legend fitting function
+
+
+# Start of benchmark atlas function
+def benchmarkAtlas(exportWebMap,templatesFolder):
+    # Compare the time per page of an atlas with exporting the web map once for each extent
+    results = collections.OrderedDict()
+    webmapJSON = json.dumps(createWebMap(100))
+    extentsFile = os.path.join(templatesFolder, "Extents.json")
+    with open(extentsFile, "w") as extentsOutput:
+        json.dump([{"xmin": index, "ymin": 0, "xmax": index + 1, "ymax": 1, "scale": 5000 * (index + 1)} for index in range(atlasPages)], extentsOutput)
+
+    startTime = time.time()
+    outputFile = exportWebMap.atlasFunction(webmapJSON,"",templatesFolder,"A4 Landscape",extentsFile,"pdf","")
+    results["atlas.secondsPerPage"] = round((time.time() - startTime) / atlasPages, 6)
+    os.remove(outputFile)
+
+    startTime = time.time()
+    for index in range(atlasPages):
+        os.remove(exportWebMap.exportWebMap(webmapJSON,"",os.path.join(templatesFolder, "A4 Landscape.mxd"),"pdf"))
+    results["single.secondsPerPage"] = round((time.time() - startTime) / atlasPages, 6)
+    return results
+# End of benchmark atlas function
+
+
+# Start of benchmark concurrency function
+def benchmarkConcurrency(exportWebMap,templatesFolder):
+    # Export a mix of web maps one at a time from a newly loaded script, then on many threads at once, and check every job gets the same result both times
+    results = collections.OrderedDict()
+    stressJobList = []
+    for index in range(stressJobs):
+        webmap = createWebMap([10, 60, 300][index % 3], index)
+        webmap["exportOptions"]["dpi"] = [96, 150, 300][(index // 3) % 3]
+        stressJobList.append({"index": index, "webmapJSON": json.dumps(webmap), "format": ["pdf", "png", "pdf,jpg:fast"][(index // 9) % 3],
+                              "templateMxd": os.path.join(templatesFolder, "Dynamic Legend" if (index % 2) else "", "A4 Landscape.mxd")})
+
+    # Reload the script before each job so the expected result has the module state of a new process
+    expectedStates = []
+    for stressJob in stressJobList:
+        reload(exportWebMap)
+        exportWebMap.enableMetrics = "true"
+        expectedStates.append(runStressJob(exportWebMap,stressJob))
+    reload(exportWebMap)
+    exportWebMap.enableMetrics = "true"
+    startTime = time.time()
+    for stressJob in stressJobList:
+        runStressJob(exportWebMap,stressJob)
+    results["concurrency.sequentialSeconds"] = round(time.time() - startTime, 6)
+
+    # Run the jobs in a different order so jobs run next to different jobs
+    shuffledJobs = list(stressJobList)
+    random.Random(1).shuffle(shuffledJobs)
+    pool = multiprocessing.pool.ThreadPool(stressThreads)
+    startTime = time.time()
+    try:
+        jobStates = pool.map(lambda stressJob: runStressJob(exportWebMap,stressJob), shuffledJobs)
+    finally:
+        pool.close()
+        pool.join()
+    results["concurrency.threadedSeconds"] = round(time.time() - startTime, 6)
+    exportWebMap.enableMetrics = "false"
+
+    # Any job with a different result has picked up state from another job
+    mismatches = 0
+    outputFiles = []
+    for stressJob, jobState in zip(shuffledJobs, jobStates):
+        outputFiles.extend(jobState.pop("outputFiles"))
+        expectedState = dict(expectedStates[stressJob["index"]])
+        expectedState.pop("outputFiles")
+        if (jobState != expectedState):
+            mismatches = mismatches + 1
+            print("STATE BLEED - Job " + str(stressJob["index"]) + " - Expected " + json.dumps(expectedState, sort_keys=True) + " but got " + json.dumps(jobState, sort_keys=True))
+    results["concurrency.jobs"] = len(shuffledJobs)
+    results["concurrency.mismatches"] = mismatches
+    # Every job should have written its own output files
+    results["concurrency.sharedOutputs"] = len(outputFiles) - len(set(outputFiles))
+    return results
+# End of benchmark concurrency function
+
+
+# Start of benchmark pool function
+def benchmarkPool(exportWebMap,templatesFolder):
+    # Export a batch with 1 to N worker processes and compare the throughput to one worker - Scaling of 1 is linear
+    results = collections.OrderedDict()
+    webmapJSON = json.dumps(createWebMap(10))
+    templateMxd = os.path.join(templatesFolder, "A4 Landscape.mxd")
+    savedCosts = dict(stubCosts)
+    stubCosts.update(poolStubCosts)
+    # Worker processes only have the stub arcpy if they are forked from this process, so use worker threads on Windows
+    if (os.name == "nt"):
+        exportWebMap.batchThreads = "true"
+    try:
+        for workerCount in poolWorkerCounts:
+            exportWebMap.batchWorkers = workerCount
+            startTime = time.time()
+            jobs = exportWebMap.runBatchPool([("Job " + str(index), webmapJSON) for index in range(poolJobs)],"",templateMxd,"pdf")
+            jobsPerSecond = poolJobs / (time.time() - startTime)
+            for job in jobs:
+                if (job["output"]):
+                    os.remove(job["output"])
+            results["pool.jobsPerSecond." + str(workerCount)] = round(jobsPerSecond, 3)
+            results["pool.scaling." + str(workerCount)] = round(jobsPerSecond / (results["pool.jobsPerSecond." + str(poolWorkerCounts[0])] * workerCount / poolWorkerCounts[0]), 3)
+            results["pool.failed." + str(workerCount)] = len([job for job in jobs if job["status"] != "success"])
+    finally:
+        stubCosts.clear()
+        stubCosts.update(savedCosts)
+        exportWebMap.batchWorkers = 1
+        exportWebMap.batchThreads = "false"
+    return results
+# End of benchmark pool function
+
+
+# Start of run stress job function
+def runStressJob(exportWebMap,stressJob):
+    # Export a job and get the state that should only depend on its web map, template and format
+    jobContext = exportWebMap.createJobContext(stressJob["templateMxd"],stressJob["format"])
+    outputs = exportWebMap.exportWebMap(stressJob["webmapJSON"],"",stressJob["templateMxd"],stressJob["format"],[],jobContext)
+    if not isinstance(outputs, dict):
+        outputs = {stressJob["format"]: {"output": outputs}}
+    jobMetrics = jobContext["metrics"]
+    jobState = {"legendOverflow": jobContext["legendOverflow"], "DPI": jobContext["DPI"],
+                "layerCount": jobMetrics.get("layerCount"), "legendItems": jobMetrics.get("legendItems"), "legendPages": jobMetrics.get("legendPages"),
+                "renderTiers": dict([(tier, jobMetrics["renderTiers"][tier]["exports"]) for tier in jobMetrics["renderTiers"]]),
+                "outputBytes": dict([(key, os.path.getsize(outputs[key]["output"])) for key in outputs]),
+                "outputFiles": [outputs[key]["output"] for key in outputs]}
+    for key in outputs:
+        os.remove(outputs[key]["output"])
+    return jobState
+# End of run stress job function
+
+
+# Start of benchmark tile cache function
+def benchmarkTileCache(exportWebMap):
+    # Fetch tiles from a stand-in tile server through the tile cache - Fresh tiles, tiles that have to be checked and the same tile requested at once
+    results = collections.OrderedDict()
+    tileServer = TileServer(("localhost", getFreePort()), TileHandler)
+    tileServer.requests = collections.Counter()
+    threading.Thread(target=tileServer.serve_forever).start()
+    exportWebMap.tileCacheFolder = tempfile.mkdtemp(prefix="TileCache")
+    exportWebMap.tileCachePort = getFreePort()
+    tileCacheServer = exportWebMap.startTileCache()
+    openURL = urllib2.build_opener(urllib2.ProxyHandler({"http": "http://localhost:" + str(exportWebMap.tileCachePort)}))
+    tileURL = "http://localhost:" + str(tileServer.server_address[1]) + "/"
+    try:
+        for cacheControl in ["fresh", "nocache"]:
+            for run in range(2):
+                startTime = time.time()
+                for index in range(tileCount):
+                    openURL.open(tileURL + cacheControl + "/" + str(index)).read()
+                results["tileCache." + cacheControl + ".secondsPerTile." + str(run + 1)] = round((time.time() - startTime) / tileCount, 6)
+
+        # Request the same tile at the same time
+        fetchThreads = [threading.Thread(target=lambda: openURL.open(tileURL + "nocache/same").read()) for index in range(tileCount)]
+        for fetchThread in fetchThreads:
+            fetchThread.start()
+        for fetchThread in fetchThreads:
+            fetchThread.join()
+
+        tileCacheStats = exportWebMap.getTileCacheStats()
+        for name in ["requests","hits","revalidated","collapsed","misses","upstreamBytes","bytesSaved","hitRatio"]:
+            results["tileCache." + name] = tileCacheStats[name]
+        results["tileCache.serverRequests"] = sum(tileServer.requests.values())
+        results["tileCache.serverRequests.same"] = tileServer.requests["/nocache/same"]
+    finally:
+        tileCacheServer.shutdown()
+        tileServer.shutdown()
+        # Close the connections the tile cache kept open to the tile server
+        for idleConnections in exportWebMap.tileCache["connections"].values():
+            for connection in idleConnections:
+                connection.close()
+        tileCacheServer.server_close()
+        tileServer.server_close()
+        shutil.rmtree(exportWebMap.tileCacheFolder, True)
+    return results
+# End of benchmark tile cache function
+
+
+# Start of benchmark error email function
+def benchmarkErrorEmail(exportWebMap):
+    # Queue errors to a stand-in email server - Repeated errors, more errors than the digest interval allows and a slow server
+    results = collections.OrderedDict()
+    emailServer = EmailServer(("localhost", getFreePort()), EmailHandler)
+    emailServer.emails = []
+    emailServer.connections = 0
+    threading.Thread(target=emailServer.serve_forever).start()
+    exportWebMap.emailServerName = "localhost"
+    exportWebMap.emailServerPort = emailServer.server_address[1]
+    exportWebMap.emailTo = "to@localhost"
+    exportWebMap.emailUser = "from@localhost"
+    exportWebMap.emailPassword = ""
+    exportWebMap.emailDigestInterval = emailDigestInterval
+    try:
+        queueSeconds = []
+        for index in range(emailErrors):
+            startTime = time.time()
+            exportWebMap.queueEmail("Benchmark error " + str(index % emailUniqueErrors))
+            queueSeconds.append(time.time() - startTime)
+            time.sleep(emailErrorInterval)
+        # Send the errors still waiting
+        startTime = time.time()
+        exportWebMap.stopEmailWorker()
+        results["errorEmail.secondsPerError.mean"] = round(sum(queueSeconds) / len(queueSeconds), 6)
+        results["errorEmail.secondsPerError.max"] = round(max(queueSeconds), 6)
+        results["errorEmail.flushSeconds"] = round(time.time() - startTime, 6)
+        results["errorEmail.emails"] = len(emailServer.emails)
+        results["errorEmail.connections"] = emailServer.connections
+        # Count the errors in the emails - A digest starts with the number of errors in it
+        errorsSent = 0
+        for emailBody in emailServer.emails:
+            if (" errors since the last email:" in emailBody):
+                errorsSent = errorsSent + int(emailBody.split(" errors since the last email:")[0].split("\n")[-1])
+            else:
+                errorsSent = errorsSent + 1
+        results["errorEmail.lostErrors"] = emailErrors - errorsSent
+    finally:
+        emailServer.shutdown()
+        emailServer.server_close()
+    return results
+# End of benchmark error email function
+
+
+# Start of get free port function
+def getFreePort():
+    freeSocket = socket.socket()
+    freeSocket.bind(("localhost", 0))
+    port = freeSocket.getsockname()[1]
+    freeSocket.close()
+    return port
+# End of get free port function
+
+
+# Start of compare results function
+def compareResults(results,baselineResults):
+    # Get the results that are worse than the baseline by more than the threshold
+    regressions = []
+    for name in results:
+        if (name in higherIsBetterResults) and (name in baselineResults) and (results[name] < baselineResults[name] * (1 - regressionThreshold)):
+            regressions.append(name + " - " + str(baselineResults[name]) + " to " + str(results[name]))
+        elif (name not in higherIsBetterResults) and (name in baselineResults) and (results[name] > baselineResults[name] * (1 + regressionThreshold)) and (results[name] - baselineResults[name] >= regressionMinimum):
+            regressions.append(name + " - " + str(baselineResults[name]) + " to " + str(results[name]))
+    return regressions
+# End of compare results function
+
+
+# Start of create web map function
+def createWebMap(layerCount,seed=1):
+    # Create a web map with a mix of service layers, vector layers with a matching service layer, drawn graphics, hidden and scale dependent layers
+    randomNumbers = random.Random(seed)
+    operationalLayers = []
+    for index in range(layerCount):
+        layerType = randomNumbers.choice(["service", "service", "service", "vector", "graphics", "group"])
+        operationalLayer = {"id": "layer" + str(index), "title": "Layer " + str(index), "layerType": layerType,
+                            "visibility": randomNumbers.random() > 0.1, "minScale": 0, "maxScale": 0,
+                            "visibleLayers": list(range(randomNumbers.randint(1, 5)))}
+        # Some layers are only drawn at some scales
+        if (randomNumbers.random() < 0.2):
+            operationalLayer["minScale"] = randomNumbers.choice([5000, 50000, 500000])
+            operationalLayer["maxScale"] = randomNumbers.choice([0, 1000])
+        operationalLayers.append(operationalLayer)
+        # Vector layers have a service layer with the same name
+        if (layerType == "vector"):
+            operationalLayers.append({"id": "layer" + str(index) + "service", "title": operationalLayer["title"], "layerType": "service", "visibility": True})
+    operationalLayers.append({"id": "roadnames", "title": "Road Name", "layerType": "service", "visibility": True})
+    return {"mapOptions": {"extent": {"xmin": 0, "ymin": 0, "xmax": 1, "ymax": 1}, "scale": 10000},
+            "operationalLayers": operationalLayers, "exportOptions": {"dpi": 150}}
+# End of create web map function
+
+
+# Start of create stub templates function
+def createStubTemplates():
+    # Create empty template files - The stub reads the page size and legend type from the template name
+    templatesFolder = tempfile.mkdtemp(prefix="Templates")
+    os.makedirs(os.path.join(templatesFolder, "Dynamic Legend"))
+    for folder in [templatesFolder, os.path.join(templatesFolder, "Dynamic Legend")]:
+        for templateName in ["A3 Landscape", "A3 Portrait", "A4 Landscape", "A4 Portrait"]:
+            open(os.path.join(folder, templateName + ".mxd"), "w").close()
+    return templatesFolder
+# End of create stub templates function
+
+
+# Start of simulate cost function
+def simulateCost(name):
+    # Count the call and wait for the simulated time it takes
+    stubCalls[name] = stubCalls[name] + 1
+    if (stubCosts.get(name)):
+        time.sleep(stubCosts[name])
+# End of simulate cost function
+
+
+# Start of stub layer class
+class StubLayer(object):
+    def __init__(self, name, isServiceLayer, isGroupLayer=False, visible=True, minScale=0, maxScale=0, serviceType="MapServer"):
+        self.name = name
+        self.isServiceLayer = isServiceLayer
+        self.isGroupLayer = isGroupLayer
+        self.visible = visible
+        self.minScale = minScale
+        self.maxScale = maxScale
+        self.serviceType = serviceType
+        self.childLayers = []
+
+    def supports(self, layerProperty):
+        return (layerProperty == "serviceProperties") and (self.isServiceLayer or (self.serviceType == "Other"))
+
+    @property
+    def serviceProperties(self):
+        return {"ServiceType": self.serviceType}
+# End of stub layer class
+
+
+# Start of stub element class
+class StubElement(object):
+    def __init__(self, type, name, elementHeight=1.0, elementWidth=1.0, elementPositionX=1.0, elementPositionY=1.0):
+        self.type = type
+        self.name = name
+        self.elementHeight = elementHeight
+        self.elementWidth = elementWidth
+        self.elementPositionX = elementPositionX
+        self.elementPositionY = elementPositionY
+# End of stub element class
+
+
+# Start of stub legend class
+class StubLegend(StubElement):
+    def __init__(self, mapDocument, name):
+        StubElement.__init__(self, "LEGEND_ELEMENT", name, 5.0, 8.0, 20.0, 15.0)
+        self.mapDocument = mapDocument
+        self.legendItems = []
+        self.columnCount = 1
+
+    def listLegendItemLayers(self):
+        # Layers removed from the map are also removed from the legend
+        self.legendItems = [legendItem for legendItem in self.legendItems if legendItem in self.mapDocument.layerSet]
+        return list(self.legendItems)
+
+    def removeItem(self, layer):
+        if layer in self.legendItems:
+            self.legendItems.remove(layer)
+
+    def adjustColumnCount(self, columnCount):
+        simulateCost("adjustColumnCount")
+        self.columnCount = columnCount
+
+    @property
+    def elementHeight(self):
+        # A dynamic legend grows with the visible items, spread evenly across the columns
+        legendItemCount = len([legendItem for legendItem in self.listLegendItemLayers() if legendItem.visible])
+        return max(int(math.ceil(float(legendItemCount) / self.columnCount)) * stubLegendItemHeight, stubLegendItemHeight)
+
+    @elementHeight.setter
+    def elementHeight(self, elementHeight):
+        pass
+
+    @property
+    def isOverflowing(self):
+        return False
+# End of stub legend class
+
+
+# Start of stub map document class
+class StubMapDocument(object):
+    def __init__(self, templateName, templateFolderName, filePath=""):
+        self.filePath = filePath
+        pageSizes = {"A3 Landscape": (42.0, 29.7), "A3 Portrait": (29.7, 42.0), "A4 Landscape": (29.7, 21.0), "A4 Portrait": (21.0, 29.7)}
+        pageSize = pageSizes.get(templateName, (29.7, 21.0))
+        self.pageSize = StubPageSize(pageSize[0], pageSize[1])
+        self.dataFrames = [StubDataFrame(self)]
+        self.layers = []
+        self.layerSet = set()
+        self.legend = StubLegend(self, "Dynamic Legend" if (templateFolderName.lower() == "dynamic legend") else "Legend")
+        self.elements = [StubElement("DATAFRAME_ELEMENT", "Webmap", 17.0, 18.0, 1.0, 2.0),
+                         StubElement("TEXT_ELEMENT", "Title", 1.0, 10.0, 1.0, pageSize[1] - 1),
+                         StubElement("PICTURE_ELEMENT", "Logo"),
+                         StubElement("MAPSURROUND_ELEMENT", "North Arrow"),
+                         StubElement("GRAPHIC_ELEMENT", "Legend Border", 12.0, 8.0, 20.0, 3.0),
+                         self.legend]
+
+    def addLayer(self, layer, groupLayer=None):
+        self.layers.append(layer)
+        self.layerSet.add(layer)
+        if (groupLayer):
+            groupLayer.childLayers.append(layer)
+        if not layer.isGroupLayer:
+            self.legend.legendItems.append(layer)
+
+    def saveACopy(self, filePath):
+        simulateCost("saveACopy")
+        stubDocuments[filePath] = copy.deepcopy(self)
+        stubDocuments[filePath].filePath = filePath
+        open(filePath, "w").close()
+# End of stub map document class
+
+
+# Start of stub page size class
+class StubPageSize(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+# End of stub page size class
+
+
+# Start of stub data frame class
+class StubDataFrame(object):
+    def __init__(self, mapDocument):
+        self.name = "Webmap"
+        self.mapDocument = mapDocument
+        self.scale = 10000
+        self.extent = None
+# End of stub data frame class
+
+
+# Start of stub extent class
+class StubExtent(object):
+    def __init__(self, XMin, YMin, XMax, YMax):
+        self.XMin = XMin
+        self.YMin = YMin
+        self.XMax = XMax
+        self.YMax = YMax
+# End of stub extent class
+
+
+# Start of stub conversion result class
+class StubConversionResult(object):
+    def __init__(self, mapDocument, DPI):
+        self.mapDocument = mapDocument
+        self.DPI = DPI
+# End of stub conversion result class
+
+
+# Start of stub PDF document class
+class StubPDFDocument(object):
+    def __init__(self, filePath):
+        self.filePath = filePath
+
+    def appendPages(self, pagePDF):
+        simulateCost("appendPages")
+        with open(self.filePath, "ab") as pdfOutput:
+            with open(pagePDF, "rb") as pageContent:
+                shutil.copyfileobj(pageContent, pdfOutput)
+
+    def saveAndClose(self):
+        pass
+# End of stub PDF document class
+
+
+# Start of stub convert web map to map document function
+def stubConvertWebMapToMapDocument(webmapJSON, templateMxd, extra_conversion_options=None):
+    simulateCost("ConvertWebMapToMapDocument")
+    webmapObject = json.loads(webmapJSON)
+    mapDocument = StubMapDocument(os.path.splitext(os.path.basename(templateMxd))[0], os.path.basename(os.path.dirname(templateMxd)),
+                                  os.path.join(stubArcpy.env.scratchFolder, "Converted_" + str(uuid.uuid1()) + ".mxd"))
+    mapDocument.dataFrames[0].scale = webmapObject["mapOptions"].get("scale", 10000)
+    # Add a layer for each operational layer - Group layers have a service layer for each visible sub layer
+    for operationalLayer in webmapObject.get("operationalLayers", []):
+        layerType = operationalLayer.get("layerType", "service")
+        visible = operationalLayer.get("visibility", True)
+        if (layerType == "group"):
+            groupLayer = StubLayer(operationalLayer["title"], True, True, visible)
+            mapDocument.addLayer(groupLayer)
+            for subLayer in operationalLayer.get("visibleLayers", []):
+                mapDocument.addLayer(StubLayer(operationalLayer["title"] + " " + str(subLayer), True, False, visible, operationalLayer.get("minScale", 0), operationalLayer.get("maxScale", 0)), groupLayer)
+        else:
+            mapDocument.addLayer(StubLayer(operationalLayer["title"], layerType == "service", False, visible, operationalLayer.get("minScale", 0), operationalLayer.get("maxScale", 0),
+                                           "Other" if (layerType == "graphics") else "MapServer"))
+    open(mapDocument.filePath, "w").close()
+    return StubConversionResult(mapDocument, webmapObject.get("exportOptions", {}).get("dpi", 96))
+# End of stub convert web map to map document function
+
+
+# Start of stub map document function
+def stubMapDocument(filePath):
+    simulateCost("MapDocument")
+    return copy.deepcopy(stubDocuments[filePath])
+# End of stub map document function
+
+
+# Start of stub list layers function
+def stubListLayers(mapDocument, wildcard=None, data_frame=None):
+    stubCalls["ListLayers"] = stubCalls["ListLayers"] + 1
+    return list(mapDocument.layers)
+# End of stub list layers function
+
+
+# Start of stub list layout elements function
+def stubListLayoutElements(mapDocument, element_type=None, wildcard=None):
+    stubCalls["ListLayoutElements"] = stubCalls["ListLayoutElements"] + 1
+    return [element for element in mapDocument.elements if (element_type is None) or (element.type == element_type)]
+# End of stub list layout elements function
+
+
+# Start of stub list data frames function
+def stubListDataFrames(mapDocument, wildcard=None):
+    return list(mapDocument.dataFrames)
+# End of stub list data frames function
+
+
+# Start of stub remove layer function
+def stubRemoveLayer(dataFrame, layer):
+    # Remove the layer and any layers in it from the map
+    mapDocument = dataFrame.mapDocument
+    for childLayer in [layer] + layer.childLayers:
+        if childLayer in mapDocument.layerSet:
+            mapDocument.layers.remove(childLayer)
+            mapDocument.layerSet.discard(childLayer)
+# End of stub remove layer function
+
+
+# Start of stub export function
+def stubExport(exportName):
+    # Create an export function that writes a file of the stub output size
+    def export(mapDocument, outputFile, *arguments, **keywordArguments):
+        simulateCost(exportName)
+        with open(outputFile, "wb") as output:
+            output.write(b"0" * stubOutputBytes)
+    return export
+# End of stub export function
+
+
+# Start of stub PDF document create function
+def stubPDFDocumentCreate(filePath):
+    open(filePath, "wb").close()
+    return StubPDFDocument(filePath)
+# End of stub PDF document create function
+
+
+# Start of tile server class
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+# End of tile server class
+
+
+# Start of tile handler class
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Stand-in tile server - /fresh/<tile> can be cached for an hour, /nocache/<tile> has to be checked with its ETag each time
+    protocol_version = "HTTP/1.1"
+    # Send the headers and body without waiting for the headers to be acknowledged
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.requests[self.path] = self.server.requests[self.path] + 1
+        etag = '"' + self.path + '"'
+        if (self.headers.get("If-None-Match") == etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        time.sleep(tileServerDelay)
+        body = b"0" * tileBytes
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Cache-Control", "max-age=3600" if self.path.startswith("/fresh/") else "no-cache")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+# End of tile handler class
+
+
+# Start of email server class
+class EmailServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+# End of email server class
+
+
+# Start of email handler class
+class EmailHandler(SocketServer.StreamRequestHandler):
+    # Stand-in email server - Accepts the SMTP commands the script sends and keeps the body of each email
+    def handle(self):
+        self.server.connections = self.server.connections + 1
+        self.reply("220 localhost")
+        while True:
+            line = self.rfile.readline().decode("utf-8")
+            if not (line):
+                return
+            command = line.strip().upper()
+            if command.startswith("EHLO") or command.startswith("HELO"):
+                self.reply("250 localhost")
+            elif (command == "DATA"):
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                bodyLines = []
+                while True:
+                    line = self.rfile.readline().decode("utf-8")
+                    if not (line) or (line.rstrip("\r\n") == "."):
+                        break
+                    bodyLines.append(line.rstrip("\r\n"))
+                time.sleep(emailServerDelay)
+                self.server.emails.append("\n".join(bodyLines))
+                self.reply("250 OK")
+            elif (command == "QUIT"):
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode("utf-8"))
+# End of email handler class
+
+
+# Start of create stub arcpy function
+def createStubArcpy():
+    # Create arcpy and arcpy.mapping modules with the functions the Export Web Map script uses
+    arcpyModule = types.ModuleType("arcpy")
+    mappingModule = types.ModuleType("arcpy.mapping")
+    arcpyModule.mapping = mappingModule
+    arcpyModule.env = types.ModuleType("arcpy.env")
+    arcpyModule.env.overwriteOutput = False
+    arcpyModule.env.scratchFolder = tempfile.mkdtemp(prefix="Scratch")
+    arcpyModule.ExecuteError = type("ExecuteError", (Exception,), {})
+    arcpyModule.GetMessages = lambda severity=0: ""
+    arcpyModule.AddMessage = lambda message: None
+    arcpyModule.AddWarning = lambda message: None
+    arcpyModule.AddError = lambda message: None
+    arcpyModule.SetParameter = lambda index, value: None
+    arcpyModule.Extent = StubExtent
+    mappingModule.ConvertWebMapToMapDocument = stubConvertWebMapToMapDocument
+    mappingModule.MapDocument = stubMapDocument
+    mappingModule.ListLayers = stubListLayers
+    mappingModule.ListLayoutElements = stubListLayoutElements
+    mappingModule.ListDataFrames = stubListDataFrames
+    mappingModule.RemoveLayer = stubRemoveLayer
+    mappingModule.ExportToPDF = stubExport("ExportToPDF")
+    mappingModule.ExportToPNG = stubExport("ExportToPNG")
+    mappingModule.ExportToJPEG = stubExport("ExportToJPEG")
+    mappingModule.PDFDocumentCreate = stubPDFDocumentCreate
+    mappingModule.PDFDocumentOpen = StubPDFDocument
+    return arcpyModule, mappingModule
+# End of create stub arcpy function
+
+
+# Start of import export web map function
+def importExportWebMap():
+    # Use the stub arcpy when the Export Web Map script imports arcpy
+    sys.modules["arcpy"] = stubArcpy
+    sys.modules["arcpy.mapping"] = stubMapping
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import ExportWebMap
+    return ExportWebMap
+# End of import export web map function
+
+
+stubArcpy, stubMapping = createStubArcpy()
+
+# This test allows the script to be used from the operating
+# system command prompt (stand-alone), in a Python IDE,
+# as a geoprocessing script tool, or as a module imported in
+# another script
+if __name__ == '__main__':
+    argv = sys.argv
+    # Delete the first argument, which is the script
+    del argv[0]
+    # If running the print service with the stub arcpy e.g. BenchmarkExportWebMap.py service <port>
+    if (len(argv) > 0) and (argv[0] == "service"):
+        argv.append("")
+        sys.exit(serviceFunction(argv[1]))
+    # Results file and baseline results file are optional
+    while (len(argv) < 2):
+        argv.append("")
+    sys.exit(mainFunction(*argv))
@@ -12,11 +12,11 @@
 # Python Version:   2.7
 #--------------------------------
 
-# Import main modules
+# Import main modules - arcpy, logging, smtplib and urllib2 are imported when first used
 import os
 import sys
-import logging
-import smtplib
+import time
+startupTimes = {"moduleStartTime": time.time()}
 
 # Set global variables
 # Logging
@@ -31,252 +31,145 @@ emailUser = ""
 emailPassword = ""
 emailSubject = ""
 emailMessage = ""
+emailDigestInterval = 60 # Minimum seconds between error emails - Errors in between are sent together in one digest with repeated errors counted
+emailQueueSize = 1000 # Maximum number of errors waiting to be emailed - Errors over this are counted in the next digest
+emailConnectionIdle = 300 # Seconds to keep the email server connection open without sending an email
 # Proxy
 enableProxy = "false"
 requestProtocol = "http" # http or https
 proxyURL = ""
 # Output
 output = None
+# Tile cache - Local HTTP proxy that caches the map and image service responses fetched while converting web maps (http only)
+enableTileCache = "false"
+tileCacheHost = "localhost"
+tileCachePort = 8081
+tileCacheFolder = "" # e.g. r"C:\Temp\ExportWebMapTileCache" - Defaults to a folder in the temp folder
+tileCacheMaxSize = 1024 # Maximum size of the cached responses in MB
+tileCacheDefaultAge = 300 # Seconds to keep responses that don't have a max age or expiry date
+tileCacheConnections = 4 # Maximum number of idle connections kept open to each server
+tileCacheStandbyInterval = 30 # Seconds between checks for the tile cache when another process is running it - This process takes over if it stops
+# Batch
+batchWorkers = 1 # Number of worker processes to export batch jobs with - 1 exports in this process
+batchQueueSize = 32 # Maximum number of batch jobs waiting on the worker processes
+batchJobTimeout = 600 # Seconds a batch job can run for before marking it as timed out and stopping its worker process
+batchThreads = "false" # Export batch jobs on threads in this process rather than in worker processes - Each job has its own job context
+# Print service - Uses the batch workers to export jobs
+serviceHost = "localhost"
+servicePort = 8080
+serviceQueueSize = 20 # Maximum number of jobs waiting to be exported before requests are turned away
+serviceJobHistory = 1000 # Number of finished jobs to keep the status of
+# Scratch space - Each job gets its own folder in the scratch folder
+enableScratchManager = "false"
+scratchQuota = 2048 # MB of delivered outputs kept before the oldest are removed
+scratchReapAge = 3600 # Seconds before the folders of jobs that didn't finish are removed
+scratchReapInterval = 300 # Seconds between checks of the scratch space by batch runs and the print service
+# Web map - Remove operational layers that are hidden or not drawn at the map scale before converting the web map
+pruneWebMapLayers = "true"
+# Rendering tiers - Export settings for each print quality. The tier comes from the DPI of the web map or a tier name in the format e.g. "pdf:best" or "png:fast:400x300"
+renderTiers = {"draft": {"resolution": 72, "jpegQuality": 60, "pngColorMode": "8-BIT_ADAPTIVE_PALETTE", "pdfImageQuality": "FASTEST"},
+               "fast": {"resolution": 96, "jpegQuality": 100, "pngColorMode": "24-BIT_TRUE_COLOR", "pdfImageQuality": "BEST"},
+               "good": {"resolution": 150, "jpegQuality": 100, "pngColorMode": "24-BIT_TRUE_COLOR", "pdfImageQuality": "BEST"},
+               "best": {"resolution": 300, "jpegQuality": 100, "pngColorMode": "24-BIT_TRUE_COLOR", "pdfImageQuality": "BEST"}}
+renderTierDPIs = {150: "good", 300: "best"} # Tier for each web map DPI - Any other DPI is printed with the fast tier
+renderSmallImagePixels = 250000 # Images with a size of up to this many pixels (e.g. 500x500 thumbnails) are exported with the fast tier
+renderDegradeQueueLength = 10 # Number of jobs waiting in the print service before fast and low priority jobs are degraded
+renderDegradeTiers = {"fast": "draft", "good": "fast"} # Tier to drop to when degraded - Best tier jobs are never degraded
+# Legend
+legendMaxColumns = 6 # Maximum number of columns for a dynamic legend page before the legend is split across more pages
+legendIndexCacheSize = 100 # Number of template and web map layer combinations to keep the legend scale ranges for
+# Output cache - Identical prints return the output already created
+enableOutputCache = "false"
+outputCacheFolder = "" # e.g. r"C:\Temp\ExportWebMapCache" - Defaults to a folder in the scratch folder
+outputCacheMaxSize = 500 # Maximum size of the cached outputs in MB
+outputCacheMaxAge = 86400 # Seconds before a cached output expires
+outputCacheExcludeLayers = [] # Titles of time sensitive layers e.g. ["Traffic Cameras"] - Web maps with these layers or a time extent are not cached
+# Metrics - Stage timings for each job
+enableMetrics = "false"
+metricsLogFile = "" # JSON lines file of the metrics for each job e.g. os.path.join(os.path.dirname(__file__), "ExportWebMapMetrics.json")
+metricsFile = "" # Prometheus text metrics file, also served from /metrics by the print service e.g. os.path.join(os.path.dirname(__file__), "ExportWebMap.prom")
+metricsBuckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120] # Histogram buckets in seconds
+# Preflight - Estimated number of legend items that fit in a template legend before it overflows
+legendItemCapacity = 20
 # ArcGIS desktop installed
 arcgisDesktop = "true"
+arcpy = None
 
-# If ArcGIS desktop installed
-if (arcgisDesktop == "true"):
-    # Import extra modules
-    import arcpy
-    # Enable data to be overwritten
-    arcpy.env.overwriteOutput = True
 # Python version check
 if sys.version_info[0] >= 3:
     # Python 3.x
-    import urllib.request as urllib2
+    import http.server as BaseHTTPServer
+    import socketserver as SocketServer
+    import queue as Queue
+    import http.client as httplib
+    from urllib.parse import unquote, urlsplit
 else:
     # Python 2.x
-    import urllib2
+    import BaseHTTPServer
+    import SocketServer
+    import Queue
+    import httplib
+    from urllib import unquote
+    from urlparse import urlsplit
 import uuid
 import json
-dynLegendOverflow = False
+import multiprocessing
+import multiprocessing.pool
+import hashlib
+import math
+import shutil
+import re
+import csv
+import zipfile
+import threading
+import collections
+import bisect
+import array
+import tempfile
+import socket
+import email.utils
+import atexit
+import signal
+templateCache = {}
+legendIndexCache = collections.OrderedDict()
+legendIndexLock = threading.Lock()
+outputCacheStats = {"hits": 0, "misses": 0, "evictions": 0}
+outputCacheLock = threading.Lock()
+metricsHistograms = {}
+metricsLock = threading.Lock()
+workerProcess = False
+workerStarts = None
+jobStarts = {}
+jobStartsLock = threading.Lock()
+scratchJobs = None
+scratchStats = {"evictions": 0, "reaped": 0}
+scratchLock = threading.Lock()
+tileCache = {"entries": collections.OrderedDict(), "bytes": 0, "folder": None, "fetches": {}, "connections": {}}
+tileCacheStats = {"requests": 0, "hits": 0, "revalidated": 0, "misses": 0, "collapsed": 0, "uncacheable": 0, "evictions": 0, "upstreamBytes": 0, "bytesSaved": 0}
+tileCacheLock = threading.Lock()
+emailState = {"queue": None, "thread": None, "connection": None, "lastSent": 0, "lastUsed": 0, "dropped": 0}
+emailStats = {"queued": 0, "emails": 0, "connections": 0, "failed": 0}
+emailLock = threading.Lock()
+hopByHopHeaders = ["connection","keep-alive","proxy-authenticate","proxy-authorization","proxy-connection","te","trailer","trailers","transfer-encoding","upgrade"]
 noLegendLayers = ["Road Name","Road Name (LINZ)","Address","Legal Description (LINZ)","Plan Number"]
 
 
 # Start of main function
 def mainFunction(webmapJSON,agsConnections,layoutTemplatesFolder,layoutTemplate,format,outputFile): # Get parameters from ArcGIS Desktop tool by seperating by comma e.g. (var1 is 1st parameter,var2 is 2nd parameter,var3 is 3rd parameter)
+    importArcpy()
     try:
         # --------------------------------------- Start of code --------------------------------------- #
-        global dynLegendOverflow
-        global noLegendLayers
-
         # Get the requested map document
         templateMxd = os.path.join(layoutTemplatesFolder, layoutTemplate + '.mxd')
 
-        if (webmapJSON):
-            # Get the web map JSON
-            webmapObject = json.loads(webmapJSON)
-            # Get the scale and adjust slightly to fix issue with cached map/image service not showing at lowest level
-            if ("scale" in webmapObject["mapOptions"]):
-                webmapObject["mapOptions"]["scale"] = webmapObject["mapOptions"]["scale"] + 0.1
-                webmapJSON = json.dumps(webmapObject)
-
-        # Convert the WebMap to a map document
-        printMessage("Converting web map to a map document...","info")
-        # If ArcGIS server connection file provided (for connecting to secured services), then add this.
-        if (agsConnections):
-            connectionFiles = {"SERVER_CONNECTION_FILE":agsConnections}
-            result = arcpy.mapping.ConvertWebMapToMapDocument(webmapJSON, templateMxd,extra_conversion_options=connectionFiles)
-        else:
-            result = arcpy.mapping.ConvertWebMapToMapDocument(webmapJSON, templateMxd)
-        mxd = result.mapDocument
-
-        # Get the DPI and reset values
-        DPI = result.DPI
-        # Good print option
-        if (int(DPI) == 150):
-            DPI = 150
-        # Best print option
-        elif (int(DPI) == 300):
-            DPI = 300
-        # Fast print option
-        else:
-            DPI = 96
-
-        # Reference the data frame that contains the webmap
-        # Note: ConvertWebMapToMapDocument renames the active dataframe in the template_mxd to "Webmap"
-        df = arcpy.mapping.ListDataFrames(mxd, 'Webmap')[0]
-
-        # Get a list of all service layer names in the map
-        serviceLayersNames = [slyr.name for slyr in arcpy.mapping.ListLayers(mxd, data_frame=df)
-                              if slyr.isServiceLayer and slyr.visible and not slyr.isGroupLayer]
-
-        # Create a list of all possible vector layer names in the map that could have a corresponding service layer
-        vectorLayersNames = [vlyr.name for vlyr in arcpy.mapping.ListLayers(mxd, data_frame=df)
-                             if not vlyr.isServiceLayer and not vlyr.isGroupLayer]
-
-        # Get a list of all service layers that do have a corresponding vector layer
-        removeServiceLayerNameList = [slyrName for slyrName in serviceLayersNames
-                               if slyrName in vectorLayersNames]
-
-        # Get a list of all vector layers that don't have a corresponding service layer
-        removeVectorLayerNameList = [vlyrName for vlyrName in vectorLayersNames
-                               if vlyrName not in serviceLayersNames]
-
-        # Remove all vector layers that don't have a corresponding service layer
-        layerCount = 0
-        for lyr in arcpy.mapping.ListLayers(mxd, data_frame=df):
-            # Check if it's an other layer type i.e drawn graphics
-            otherLayerType = False
-            if lyr.supports("serviceProperties"):
-                if (lyr.serviceProperties["ServiceType"].lower() == "other"):
-                    otherLayerType = True
-
-            if not lyr.isGroupLayer \
-            and not lyr.isServiceLayer \
-            and lyr.name in removeVectorLayerNameList \
-            and lyr.name in vectorLayersNames:
-                # If it's an other layer type i.e drawn graphics, don't remove
-                if not otherLayerType:
-                    arcpy.mapping.RemoveLayer(df, lyr)
-            layerCount = layerCount + 1
-
-        # If there is a legend element
-        legendPDF = ""
-        if (len(arcpy.mapping.ListLayoutElements(mxd, "LEGEND_ELEMENT")) > 0):
-            # Reference the legend in the map document
-            legend = arcpy.mapping.ListLayoutElements(mxd, "LEGEND_ELEMENT")[0]
-
-            # Get a list of service layers that are on in the legend because the incoming JSON can specify which service layers/sublayers are on/off in the legend
-            legendServiceLayerNames = [lslyr.name for lslyr in legend.listLegendItemLayers()
-                                       if lslyr.isServiceLayer and not lslyr.isGroupLayer]
-
-            # Remove vector layers from the legend where the corresponding service layer is also off in the legend
-            for lvlyr in legend.listLegendItemLayers():
-                if not lvlyr.isServiceLayer \
-                and lvlyr.name not in legendServiceLayerNames \
-                and not lvlyr.isGroupLayer \
-                and lvlyr.name in vectorLayersNames:
-                    legend.removeItem(lvlyr)
-
-            # Remove all layers from the legend specified in the no legend layers global array
-            for lvlyr in legend.listLegendItemLayers():
-                if lvlyr.name in noLegendLayers:
-                    legend.removeItem(lvlyr)
-
-            # Remove all service layers that do have a corresponding vector layer - Make not visible
-            for slyr in arcpy.mapping.ListLayers(mxd, data_frame=df):
-                if slyr.isServiceLayer \
-                and slyr.name in removeServiceLayerNameList \
-                and slyr.name in serviceLayersNames \
-                and not slyr.isGroupLayer:
-                    slyr.visible= False
-                    arcpy.mapping.RemoveLayer(df, slyr)
-
-            # Get the number of legend items
-            legendItemsVisible = 0
-            mapScale = df.scale
-            for layer in legend.listLegendItemLayers():
-                # If the legend item is visible on the current map
-                if (layer.visible == True):
-                    if ((layer.minScale > mapScale) or (layer.minScale == 0)) and (layer.maxScale < mapScale):
-                        legendItemsVisible = legendItemsVisible + 1
-
-            # If there are no legend items
-            if (legendItemsVisible == 0):
-                # Remove the legend by moving it off the page
-                legend.elementPositionX = -5000
-                legend.elementPositionY = -5000
-
-                ### Custom code for WCC ###
-##                # Remove all graphic elements
-##                for element in arcpy.mapping.ListLayoutElements(mxd, "GRAPHIC_ELEMENT"):
-##                    # Remove the graphic by moving it off the page
-##                    element.elementPositionX = -5000
-##                    element.elementPositionY = -5000
-
-                # Resize data frame element if needed by adding values - Height, width, X and Y
-                dataFrameElement = arcpy.mapping.ListLayoutElements(mxd, "DATAFRAME_ELEMENT")[0]
-                reSizeElement(mxd,"DATAFRAME_ELEMENT",dataFrameElement.elementHeight,mxd.pageSize.width-2,dataFrameElement.elementPositionX,dataFrameElement.elementPositionY)
-
-            # If there is a legend element
-            if (len(arcpy.mapping.ListLayoutElements(mxd, "LEGEND_ELEMENT")) > 0):
-                # Reference the legend in the map document
-                legend = arcpy.mapping.ListLayoutElements(mxd, "LEGEND_ELEMENT")[0]
-
-                # If it is a dynamic legend
-                if (legend.name.lower() == "dynamic legend"):
-                    # Get the size of the legend border
-                    for element in arcpy.mapping.ListLayoutElements(mxd, "GRAPHIC_ELEMENT"):
-                        # If there is a legend border element
-                        if (element.name.lower() == "legend border"):
-                            # If the legend is larger than the legend border (minus a 0.2 buffer) i.e. Is overflowing
-                            if (legend.elementHeight > (element.elementHeight-0.2)):
-                                # Set the legend overflowing parameter to true
-                                dynLegendOverflow = True
-
-            # If legend is full for PDFs
-            if (((legend.isOverflowing) or (dynLegendOverflow)) and (format.lower() == "pdf")):
-                printMessage("Legend is full, creating legend on new page...","info")
-
-                # Create legend page
-                legendPDF = createLegend(mxd)
-
-                # Remove the legend by moving it off the page
-                legend.elementPositionX = -5000
-                legend.elementPositionY = -5000
-
-                ### Custom code for WCC ###
-##                # Remove all graphic elements
-##                for element in arcpy.mapping.ListLayoutElements(mxd, "GRAPHIC_ELEMENT"):
-##                    # Remove the graphic by moving it off the page
-##                    element.elementPositionX = -5000
-##                    element.elementPositionY = -5000
-
-                # Resize data frame element if needed by adding values - Height, width, X and Y
-                dataFrameElement = arcpy.mapping.ListLayoutElements(mxd, "DATAFRAME_ELEMENT")[0]
-                reSizeElement(mxd,"DATAFRAME_ELEMENT",dataFrameElement.elementHeight,mxd.pageSize.width-2,dataFrameElement.elementPositionX,dataFrameElement.elementPositionY)
-        # No legend element
+        # Export the web map to an output file
+        outputFile = exportWebMap(webmapJSON,agsConnections,templateMxd,format)
+        # If more than one format, return the outputs for each format as JSON
+        if isinstance(outputFile, dict):
+            outputFile = json.dumps(outputFile)
+            output = outputFile
         else:
-            ### Custom code for WCC ###
-##            # Remove all graphic elements
-##            for element in arcpy.mapping.ListLayoutElements(mxd, "GRAPHIC_ELEMENT"):
-##                # Remove the graphic by moving it off the page
-##                element.elementPositionX = -5000
-##                element.elementPositionY = -5000
-
-            # Resize data frame element if needed by adding values - Height, width, X and Y
-            dataFrameElement = arcpy.mapping.ListLayoutElements(mxd, "DATAFRAME_ELEMENT")[0]
-            reSizeElement(mxd,"DATAFRAME_ELEMENT",dataFrameElement.elementHeight,mxd.pageSize.width-2,dataFrameElement.elementPositionX,dataFrameElement.elementPositionY)
-
-        ### Debugging ###
-##        mxd.saveACopy(r"C:\Temp\OutputMap.mxd")
-
-        # Use the uuid module to generate a GUID as part of the output name
-        # This will ensure a unique output name
-        output = 'Map_{}.{}'.format(str(uuid.uuid1()), format)
-        outputFile = os.path.join(arcpy.env.scratchFolder, output)
-
-        # Export the WebMap
-        printMessage("Exporting map to an output file...","info")
-        if format.lower() == "pdf":
-            # If legend page for PDF
-            if (legendPDF):
-                # Create a new PDF and append the pages
-                output = 'Map1_{}.{}'.format(str(uuid.uuid1()), format)
-                outputFile1 = os.path.join(arcpy.env.scratchFolder, output)
-                arcpy.mapping.ExportToPDF(mxd, outputFile1, resolution=DPI)
-                outputPDF = arcpy.mapping.PDFDocumentCreate(outputFile)
-                outputPDF.appendPages(outputFile1)
-                outputPDF.appendPages(legendPDF)
-            # Just one page PDF
-            else:
-                arcpy.mapping.ExportToPDF(mxd, outputFile, resolution=DPI)
-        elif format.lower() == "jpg":
-            arcpy.mapping.ExportToJPEG(mxd, outputFile)
-        elif format.lower() == "png":
-            arcpy.mapping.ExportToPNG(mxd, outputFile)
-
-        # Clean up - delete the map document reference
-        filePath = mxd.filePath
-        del mxd, result
-        os.remove(filePath)
+            output = os.path.basename(outputFile)
         # --------------------------------------- End of code --------------------------------------- #
         # If called from gp tool return the arcpy parameter
         if __name__ == '__main__':
@@ -317,34 +210,12 @@ def mainFunction(webmapJSON,agsConnections,layoutTemplatesFolder,layoutTemplate,
             logMessage.close()
             logger.handlers = []
         if (sendErrorEmail == "true"):
-            # Send email
-            sendEmail(errorMessage)
+            # Queue the email - Sent in the background
+            queueEmail(errorMessage)
     # If python error
     except Exception as e:
-        errorMessage = ""
         # Build and show the error message
-        # If many arguments
-        if (e.args):
-            for i in range(len(e.args)):
-                if (i == 0):
-                    # Python version check
-                    if sys.version_info[0] >= 3:
-                        # Python 3.x
-                        errorMessage = str(e.args[i]).encode('utf-8').decode('utf-8')
-                    else:
-                        # Python 2.x
-                        errorMessage = unicode(e.args[i]).encode('utf-8')
-                else:
-                    # Python version check
-                    if sys.version_info[0] >= 3:
-                        # Python 3.x
-                        errorMessage = errorMessage + " " + str(e.args[i]).encode('utf-8').decode('utf-8')
-                    else:
-                        # Python 2.x
-                        errorMessage = errorMessage + " " + unicode(e.args[i]).encode('utf-8')
-        # Else just one argument
-        else:
-            errorMessage = e
+        errorMessage = getErrorMessage(e)
         printMessage(errorMessage,"error")
         # Logging
         if (enableLogging == "true"):
@@ -357,15 +228,1767 @@ def mainFunction(webmapJSON,agsConnections,layoutTemplatesFolder,layoutTemplate,
             logMessage.close()
             logger.handlers = []
         if (sendErrorEmail == "true"):
-            # Send email
-            sendEmail(errorMessage)
+            # Queue the email - Sent in the background
+            queueEmail(errorMessage)
 # End of main function
 
 
+# Start of import arcpy function
+def importArcpy():
+    global arcpy
+    # If ArcGIS desktop installed and arcpy has not been imported yet - Importing arcpy takes a few seconds so only do it when needed
+    if (arcgisDesktop == "true") and (arcpy is None):
+        importStartTime = time.time()
+        import arcpy
+        # Enable data to be overwritten
+        arcpy.env.overwriteOutput = True
+        startupTimes["arcpySeconds"] = round(time.time() - importStartTime,3)
+    return arcpy
+# End of import arcpy function
+
+
+# Start of preflight function
+def preflightFunction(webmapJSON,layoutTemplatesFolder,layoutTemplate,format): # Check a web map can be printed and predict if the legend will overflow, without importing arcpy
+    preflightStartTime = time.time()
+    preflight = {"valid": True, "errors": [], "templateMxd": os.path.join(layoutTemplatesFolder, layoutTemplate + '.mxd'),
+                 "operationalLayers": 0, "legendItems": 0, "legendOverflow": False}
+
+    # If a web map JSON file has been provided
+    if os.path.isfile(webmapJSON):
+        with open(webmapJSON) as webmapFile:
+            webmapJSON = webmapFile.read()
+    # Check the web map JSON
+    try:
+        webmapObject = json.loads(webmapJSON)
+        if not isinstance(webmapObject.get("mapOptions"), dict) or ("extent" not in webmapObject["mapOptions"]):
+            preflight["errors"].append("Web map has no map options extent")
+        if not isinstance(webmapObject.get("operationalLayers", []), list):
+            preflight["errors"].append("Web map operational layers is not a list")
+            webmapObject["operationalLayers"] = []
+    except (ValueError, AttributeError) as e:
+        preflight["errors"].append("Web map JSON is not valid - " + str(getErrorMessage(e)))
+        webmapObject = None
+    # Check the template and format
+    if preflight["templateMxd"] not in loadTemplates(layoutTemplatesFolder):
+        preflight["errors"].append("Layout template not found - " + layoutTemplate)
+    try:
+        parseFormats(format)
+    except ValueError as e:
+        preflight["errors"].append(str(getErrorMessage(e)))
+
+    # Predict the number of legend items from the layers visible at the map scale
+    if (webmapObject) and isinstance(webmapObject.get("mapOptions"), dict):
+        mapScale = webmapObject["mapOptions"].get("scale", 0)
+        for operationalLayer in webmapObject.get("operationalLayers", []):
+            preflight["operationalLayers"] = preflight["operationalLayers"] + 1
+            if (operationalLayer.get("visibility", True) == False) or (operationalLayer.get("title") in noLegendLayers):
+                continue
+            minScale = operationalLayer.get("minScale", 0)
+            maxScale = operationalLayer.get("maxScale", 0)
+            if (mapScale) and not (((minScale > mapScale) or (minScale == 0)) and (maxScale < mapScale)):
+                continue
+            # Map service layers have a legend item for each visible sub layer
+            preflight["legendItems"] = preflight["legendItems"] + max(len(operationalLayer.get("visibleLayers", [])), 1)
+        preflight["legendOverflow"] = preflight["legendItems"] > int(legendItemCapacity)
+
+    preflight["valid"] = len(preflight["errors"]) == 0
+    preflight["startupSeconds"] = round(preflightStartTime - startupTimes["moduleStartTime"],3)
+    preflight["seconds"] = round(time.time() - preflightStartTime,3)
+    return preflight
+# End of preflight function
+
+
+# Start of export web map function
+def exportWebMap(webmapJSON,agsConnections,templateMxd,format,degradeTiers=[],jobContext=None):
+    importArcpy()
+
+    # Keep the state of this export in its own job context so exports can run at the same time
+    if (jobContext is None):
+        jobContext = createJobContext(templateMxd,format)
+    stageTime = jobContext["startTime"]
+    # Get the formats to export - One format returns the output file, more than one returns a dictionary of outputs
+    exportFormats = parseFormats(format)
+    cacheKey = None
+    legendIndexKey = None
+    if (webmapJSON):
+        # Get the web map JSON
+        webmapObject = json.loads(webmapJSON)
+
+        # If caching outputs, return the cached output if this print has been done before
+        if (enableOutputCache == "true") and (len(exportFormats) == 1):
+            cacheKey = getOutputCacheKey(webmapObject,agsConnections,templateMxd,format)
+            if (cacheKey):
+                cachedFile = getCachedOutput(cacheKey,exportFormats[0]["format"])
+                if (cachedFile):
+                    printMessage("Returning cached output...","info")
+                    timeStage(jobContext,"parse",stageTime)
+                    setMetric(jobContext,"cacheHit",True)
+                    finishMetrics(jobContext,[cachedFile])
+                    return cachedFile
+
+        # Adjust the scale and remove layers that won't be drawn before converting the web map
+        webmapJSON = prepareWebMapJSON(webmapJSON,webmapObject,jobContext)
+        legendIndexKey = getLegendIndexKey(webmapObject,templateMxd)
+    stageTime = timeStage(jobContext,"parse",stageTime)
+
+    # Get a scratch folder for the job outputs
+    jobFolder = getJobScratchFolder()
+    jobContext["jobFolder"] = jobFolder
+
+    # Convert the WebMap to a map document
+    result = convertWebMap(webmapJSON,agsConnections,templateMxd)
+    mxd = result.mapDocument
+    stageTime = timeStage(jobContext,"convert",stageTime)
+
+    # Get the template layout information and the layout elements in the map document - Listed once and reused for the whole job
+    layoutElements = listLayoutElements(mxd)
+    templateInfo = getTemplateInfo(templateMxd,mxd,layoutElements)
+    dataFrameElement = layoutElements["DATAFRAME_ELEMENT"][0]
+
+    # Get the DPI and reset values
+    DPI = getPrintDPI(result.DPI)
+    jobContext["DPI"] = DPI
+    setMetric(jobContext,"DPI",DPI)
+
+    # Reference the data frame that contains the webmap
+    # Note: ConvertWebMapToMapDocument renames the active dataframe in the template_mxd to "Webmap"
+    df = arcpy.mapping.ListDataFrames(mxd, 'Webmap')[0]
+
+    # Remove the layers that have been replaced by another layer from the map and legend
+    legend = None
+    if (templateInfo["legendName"]):
+        legend = layoutElements["LEGEND_ELEMENT"][0]
+    layerIndex = reconcileLayers(mxd,df,legend,legendIndexKey)
+    setMetric(jobContext,"layerCount",layerIndex["layerCount"])
+    stageTime = timeStage(jobContext,"layers",stageTime)
+
+    # If there is a legend element
+    legendPDFs = []
+    if (legend):
+        # Get the number of legend items
+        legendItemsVisible = countLegendItems(layerIndex["legendIndex"],df.scale)
+        setMetric(jobContext,"legendItems",legendItemsVisible)
+
+        # If there are no legend items
+        if (legendItemsVisible == 0):
+            # Remove the legend by moving it off the page
+            legend.elementPositionX = -5000
+            legend.elementPositionY = -5000
+
+            ### Custom code for WCC ###
+##            # Remove all graphic elements
+##            for element in arcpy.mapping.ListLayoutElements(mxd, "GRAPHIC_ELEMENT"):
+##                # Remove the graphic by moving it off the page
+##                element.elementPositionX = -5000
+##                element.elementPositionY = -5000
+
+            # Resize data frame element if needed by adding values - Height, width, X and Y
+            reSizeElement(dataFrameElement,dataFrameElement.elementHeight,templateInfo["pageWidth"]-2,dataFrameElement.elementPositionX,dataFrameElement.elementPositionY)
+
+        # If it is a dynamic legend with a legend border
+        if (templateInfo["legendName"].lower() == "dynamic legend") and (templateInfo["legendBorderHeight"] is not None):
+            # If the legend is larger than the legend border (minus a 0.2 buffer) i.e. Is overflowing
+            if (legend.elementHeight > (templateInfo["legendBorderHeight"]-0.2)):
+                # Set the legend overflowing parameter to true
+                jobContext["legendOverflow"] = True
+
+        # If legend is full for PDFs
+        if (((legend.isOverflowing) or (jobContext["legendOverflow"])) and ("pdf" in [exportFormat["format"] for exportFormat in exportFormats])):
+            printMessage("Legend is full, creating legend on new page...","info")
+            stageTime = timeStage(jobContext,"legend",stageTime)
+
+            # Create legend page
+            legendPDFs = createLegend(mxd,templateInfo,layoutElements,jobContext)
+            setMetric(jobContext,"legendPages",len(legendPDFs))
+            stageTime = time.time()
+
+            # Remove the legend by moving it off the page
+            legend.elementPositionX = -5000
+            legend.elementPositionY = -5000
+
+            ### Custom code for WCC ###
+##            # Remove all graphic elements
+##            for element in arcpy.mapping.ListLayoutElements(mxd, "GRAPHIC_ELEMENT"):
+##                # Remove the graphic by moving it off the page
+##                element.elementPositionX = -5000
+##                element.elementPositionY = -5000
+
+            # Resize data frame element if needed by adding values - Height, width, X and Y
+            reSizeElement(dataFrameElement,dataFrameElement.elementHeight,templateInfo["pageWidth"]-2,dataFrameElement.elementPositionX,dataFrameElement.elementPositionY)
+    # No legend element
+    else:
+        ### Custom code for WCC ###
+##        # Remove all graphic elements
+##        for element in arcpy.mapping.ListLayoutElements(mxd, "GRAPHIC_ELEMENT"):
+##            # Remove the graphic by moving it off the page
+##            element.elementPositionX = -5000
+##            element.elementPositionY = -5000
+
+        # Resize data frame element if needed by adding values - Height, width, X and Y
+        reSizeElement(dataFrameElement,dataFrameElement.elementHeight,templateInfo["pageWidth"]-2,dataFrameElement.elementPositionX,dataFrameElement.elementPositionY)
+
+    stageTime = timeStage(jobContext,"legend",stageTime)
+
+    ### Debugging ###
+##    mxd.saveACopy(r"C:\Temp\OutputMap.mxd")
+
+    # Export the WebMap in each format from the same map document
+    outputFiles = collections.OrderedDict()
+    renderTotals = {}
+    degraded = False
+    try:
+        for exportFormat in exportFormats:
+            formatStartTime = time.time()
+            # Use the uuid module to generate a GUID as part of the output name
+            # This will ensure a unique output name
+            output = 'Map_{}.{}'.format(str(uuid.uuid1()), exportFormat["format"])
+            outputFile = os.path.join(jobFolder, output)
+
+            # Get the export settings for the rendering tier - A resolution in the format is always used
+            tier = getRenderTier(result.DPI,exportFormat,degradeTiers)
+            if (tier != getRenderTier(result.DPI,exportFormat)):
+                degraded = True
+            renderSettings = renderTiers[tier]
+            resolution = exportFormat["resolution"] or renderSettings["resolution"]
+
+            # Export the WebMap
+            printMessage("Exporting map to an output file (" + tier + " tier)...","info")
+            if exportFormat["format"] == "pdf":
+                arcpy.mapping.ExportToPDF(mxd, outputFile, resolution=resolution, image_quality=renderSettings["pdfImageQuality"])
+                # If legend pages for PDF
+                if (legendPDFs):
+                    stageTime = timeStage(jobContext,"export",stageTime)
+                    # Append the legend pages to the map PDF
+                    assemblePDF(outputFile,legendPDFs)
+                    stageTime = timeStage(jobContext,"assemble",stageTime)
+            # If an image size has been given, export the data frame at that size e.g. For a thumbnail
+            elif (exportFormat["width"]):
+                if exportFormat["format"] == "jpg":
+                    arcpy.mapping.ExportToJPEG(mxd, outputFile, df, df_export_width=exportFormat["width"], df_export_height=exportFormat["height"], resolution=resolution, jpeg_quality=renderSettings["jpegQuality"])
+                else:
+                    arcpy.mapping.ExportToPNG(mxd, outputFile, df, df_export_width=exportFormat["width"], df_export_height=exportFormat["height"], resolution=resolution, color_mode=renderSettings["pngColorMode"])
+            elif exportFormat["format"] == "jpg":
+                arcpy.mapping.ExportToJPEG(mxd, outputFile, resolution=resolution, jpeg_quality=renderSettings["jpegQuality"])
+            elif exportFormat["format"] == "png":
+                arcpy.mapping.ExportToPNG(mxd, outputFile, resolution=resolution, color_mode=renderSettings["pngColorMode"])
+            outputFiles[exportFormat["key"]] = {"output": outputFile, "seconds": round(time.time() - formatStartTime,3), "tier": tier, "bytes": os.path.getsize(outputFile)}
+
+            # Add the render time and bytes to the totals for the tier
+            renderTotal = renderTotals.setdefault(tier, {"exports": 0, "seconds": 0.0, "bytes": 0})
+            renderTotal["exports"] = renderTotal["exports"] + 1
+            renderTotal["seconds"] = round(renderTotal["seconds"] + outputFiles[exportFormat["key"]]["seconds"],3)
+            renderTotal["bytes"] = renderTotal["bytes"] + outputFiles[exportFormat["key"]]["bytes"]
+            stageTime = timeStage(jobContext,"export",stageTime)
+    finally:
+        # Clean up - delete the legend pages
+        for legendPDF in legendPDFs:
+            if os.path.isfile(legendPDF):
+                os.remove(legendPDF)
+    setMetric(jobContext,"renderTiers",renderTotals)
+    setMetric(jobContext,"degraded",degraded)
+    jobContext["degraded"] = degraded
+
+    # Clean up - delete the map document reference
+    filePath = mxd.filePath
+    del mxd, result
+    os.remove(filePath)
+
+    # If caching outputs, add the output to the cache - Degraded outputs are not cached
+    if (cacheKey) and not (degraded):
+        addCachedOutput(cacheKey,exportFormats[0]["format"],outputFile)
+    deliverJobScratch(jobFolder)
+    timeStage(jobContext,"cleanup",stageTime)
+    finishMetrics(jobContext,[outputFiles[key]["output"] for key in outputFiles])
+    # If one format, return the output file
+    if (len(outputFiles) == 1):
+        return outputFile
+    # Else return the output file and export time for each format
+    setMetric(jobContext,"formatSeconds",dict([(key, outputFiles[key]["seconds"]) for key in outputFiles]))
+    return outputFiles
+# End of export web map function
+
+
+# Start of parse formats function
+def parseFormats(format):
+    # Get the formats to export e.g. "pdf" or "pdf,png:96:400x300" - Each format can have a resolution or rendering tier and an image size (width x height in pixels)
+    exportFormats = []
+    for formatText in format.split(","):
+        formatParts = formatText.strip().lower().split(":")
+        exportFormat = {"key": formatText.strip(), "format": formatParts[0], "resolution": None, "tier": None, "width": None, "height": None}
+        if (exportFormat["format"] not in ["pdf","jpg","png"]):
+            raise ValueError("Format not supported - " + formatParts[0])
+        if (len(formatParts) > 1) and (formatParts[1] in renderTiers):
+            exportFormat["tier"] = formatParts[1]
+        elif (len(formatParts) > 1) and (formatParts[1]):
+            exportFormat["resolution"] = int(formatParts[1])
+        if (len(formatParts) > 2) and (formatParts[2]) and (exportFormat["format"] != "pdf"):
+            exportFormat["width"], exportFormat["height"] = [int(size) for size in formatParts[2].split("x")]
+        exportFormats.append(exportFormat)
+    return exportFormats
+# End of parse formats function
+
+
+# Start of convert web map function
+def convertWebMap(webmapJSON,agsConnections,templateMxd):
+    # Convert the WebMap to a map document
+    printMessage("Converting web map to a map document...","info")
+    # If ArcGIS server connection file provided (for connecting to secured services), then add this.
+    if (agsConnections):
+        connectionFiles = {"SERVER_CONNECTION_FILE":agsConnections}
+        return arcpy.mapping.ConvertWebMapToMapDocument(webmapJSON, templateMxd,extra_conversion_options=connectionFiles)
+    else:
+        return arcpy.mapping.ConvertWebMapToMapDocument(webmapJSON, templateMxd)
+# End of convert web map function
+
+
+# Start of reconcile layers function
+def reconcileLayers(mxd,df,legend,legendIndexKey=None):
+    # Classify all the layers in the map in one pass
+    layerIndex = classifyLayers(mxd,df)
+
+    # Remove all vector layers that don't have a corresponding service layer
+    for lyr in layerIndex["removeVectorLayers"]:
+        arcpy.mapping.RemoveLayer(df, lyr)
+
+    # If there is a legend element
+    if (legend):
+        # Get the legend layers once for the job
+        legendLayers = legend.listLegendItemLayers()
+        # Get a list of service layers that are on in the legend because the incoming JSON can specify which service layers/sublayers are on/off in the legend
+        legendServiceLayerNames = set([lslyr.name for lslyr in legendLayers
+                                       if lslyr.isServiceLayer and not lslyr.isGroupLayer])
+        noLegendLayerNames = set(noLegendLayers)
+        removeServiceLayerNames = set([slyr.name for slyr in layerIndex["removeServiceLayers"]])
+
+        indexLegendLayers = []
+        for lvlyr in legendLayers:
+            # Remove vector layers from the legend where the corresponding service layer is also off in the legend
+            # and all layers specified in the no legend layers global array
+            if (not lvlyr.isServiceLayer \
+            and lvlyr.name not in legendServiceLayerNames \
+            and not lvlyr.isGroupLayer \
+            and lvlyr.name in layerIndex["vectorLayersNames"]) \
+            or (lvlyr.name in noLegendLayerNames):
+                legend.removeItem(lvlyr)
+            # Service layers removed from the map below are also removed from the legend
+            elif not (lvlyr.isServiceLayer and not lvlyr.isGroupLayer and lvlyr.name in removeServiceLayerNames):
+                indexLegendLayers.append(lvlyr)
+
+        # Remove all service layers that do have a corresponding vector layer - Make not visible
+        # Note: Done after the legend has been filtered as the legend filter needs these service layers
+        for slyr in layerIndex["removeServiceLayers"]:
+            slyr.visible = False
+            arcpy.mapping.RemoveLayer(df, slyr)
+
+        # Index the scale ranges of the layers left in the legend
+        layerIndex["legendIndex"] = getLegendIndex(indexLegendLayers,legendIndexKey)
+    return layerIndex
+# End of reconcile layers function
+
+
+# Start of get legend index key function
+def getLegendIndexKey(webmapObject,templateMxd):
+    # Legend layers and their scale ranges come from the template and the operational layers and legend options in the web map
+    # Features in feature collections are left out as they can be large and don't change the legend layers
+    layerKeys = []
+    for operationalLayer in webmapObject.get("operationalLayers", []):
+        if ("featureCollection" in operationalLayer):
+            featureCollection = dict(operationalLayer["featureCollection"])
+            featureCollection["layers"] = [dict(featureLayer, featureSet=dict([(key, value) for key, value in featureLayer.get("featureSet", {}).items() if key != "features"]))
+                                           for featureLayer in featureCollection.get("layers", [])]
+            operationalLayer = dict(operationalLayer, featureCollection=featureCollection)
+        layerKeys.append(operationalLayer)
+    # Include when the template was last changed, as the template layout is read again when it changes
+    indexText = json.dumps([layerKeys, webmapObject.get("layoutOptions", {}).get("legendOptions", {})], sort_keys=True, separators=(",", ":")) \
+                + "|" + os.path.abspath(templateMxd).lower() + "|" + str(os.path.getmtime(templateMxd) if os.path.isfile(templateMxd) else "") + "|" + "|".join(noLegendLayers)
+    return hashlib.sha1(indexText.encode("utf-8")).hexdigest()
+# End of get legend index key function
+
+
+# Start of get legend index function
+def getLegendIndex(legendLayers,legendIndexKey):
+    # If the legend layers have been indexed for this template and web map layers
+    with legendIndexLock:
+        if (legendIndexKey) and (legendIndexKey in legendIndexCache):
+            return legendIndexCache[legendIndexKey]
+
+    # Read the visibility and scale range of each legend layer once - Layers that can't be drawn at any scale are left out
+    maxScales = []
+    minScales = []
+    for layer in legendLayers:
+        if (layer.visible == True):
+            maxScale = layer.maxScale
+            # A min scale of 0 means there is no min scale
+            minScale = layer.minScale or float("inf")
+            if (maxScale < minScale):
+                maxScales.append(maxScale)
+                minScales.append(minScale)
+    legendIndex = {"maxScales": array.array("d", sorted(maxScales)), "minScales": array.array("d", sorted(minScales))}
+
+    if (legendIndexKey):
+        with legendIndexLock:
+            legendIndexCache[legendIndexKey] = legendIndex
+            # Remove the oldest indexes once the cache is full
+            while (len(legendIndexCache) > legendIndexCacheSize):
+                legendIndexCache.popitem(last=False)
+    return legendIndex
+# End of get legend index function
+
+
+# Start of count legend items function
+def countLegendItems(legendIndex,mapScale):
+    # Legend items visible at the map scale are drawn at scales above their max scale and below their min scale
+    # i.e. Items with a max scale below the map scale, less those that also have a min scale at or below the map scale
+    return bisect.bisect_left(legendIndex["maxScales"], mapScale) - bisect.bisect_right(legendIndex["minScales"], mapScale)
+# End of count legend items function
+
+
+# Start of prepare web map JSON function
+def prepareWebMapJSON(webmapJSON,webmapObject,jobContext,pruneByScale=True):
+    webmapBytes = len(webmapJSON)
+    mapScale = webmapObject["mapOptions"].get("scale")
+
+    # Get the operational layers that won't be drawn - Hidden or not drawn at the map scale
+    prunedLayers = []
+    if (pruneWebMapLayers == "true") and (mapScale):
+        operationalLayers = webmapObject.get("operationalLayers", [])
+        layerTitles = collections.Counter([operationalLayer.get("title") for operationalLayer in operationalLayers])
+        for operationalLayer in operationalLayers:
+            minScale = operationalLayer.get("minScale", 0)
+            maxScale = operationalLayer.get("maxScale", 0)
+            if (operationalLayer.get("visibility", True) == False) \
+            or ((pruneByScale) and (minScale) and (mapScale > minScale)) \
+            or ((pruneByScale) and (maxScale) and (mapScale < maxScale)):
+                # Keep layers that share a name with another layer as these are matched up with their service layer once converted
+                if (layerTitles[operationalLayer.get("title")] == 1):
+                    prunedLayers.append(operationalLayer)
+
+    # If there are layers to remove, remove them and the legend entries for them
+    if (prunedLayers):
+        prunedLayerIDs = set([operationalLayer.get("id") for operationalLayer in prunedLayers])
+        # Match the pruned layers by object rather than comparing their contents, which can include large feature collections
+        prunedLayerObjects = set([id(operationalLayer) for operationalLayer in prunedLayers])
+        webmapObject["operationalLayers"] = [operationalLayer for operationalLayer in webmapObject["operationalLayers"]
+                                             if id(operationalLayer) not in prunedLayerObjects]
+        legendOptions = webmapObject.get("layoutOptions", {}).get("legendOptions", {})
+        if ("operationalLayers" in legendOptions):
+            legendOptions["operationalLayers"] = [legendLayer for legendLayer in legendOptions["operationalLayers"]
+                                                  if legendLayer.get("id") not in prunedLayerIDs]
+
+    # Get the scale and adjust slightly to fix issue with cached map/image service not showing at lowest level
+    if (mapScale is not None):
+        webmapObject["mapOptions"]["scale"] = mapScale + 0.1
+        # If no layers have been removed, change the scale in the JSON text rather than writing out the whole web map again
+        scaleMatch = re.compile(r'("scale"\s*:\s*)(-?[0-9.eE+-]+)').search(webmapJSON, max(webmapJSON.find('"mapOptions"'), 0))
+        if (not prunedLayers) and (scaleMatch) and (float(scaleMatch.group(2)) == mapScale):
+            webmapJSON = webmapJSON[:scaleMatch.start(2)] + repr(mapScale + 0.1) + webmapJSON[scaleMatch.end(2):]
+        else:
+            webmapJSON = json.dumps(webmapObject)
+
+    if (prunedLayers):
+        printMessage("Removed " + str(len(prunedLayers)) + " layers that won't be drawn from the web map, saving " + str(webmapBytes - len(webmapJSON)) + " bytes...","info")
+    setMetric(jobContext,"layersPruned",len(prunedLayers))
+    setMetric(jobContext,"webmapBytesSaved",webmapBytes - len(webmapJSON))
+    return webmapJSON
+# End of prepare web map JSON function
+
+
+# Start of get print DPI function
+def getPrintDPI(DPI):
+    # Fast, good or best print option
+    return renderTiers[getRenderTier(DPI)]["resolution"]
+# End of get print DPI function
+
+
+# Start of get render tier function
+def getRenderTier(DPI,exportFormat=None,degradeTiers=[]):
+    # Get the tier from the web map DPI - Good (150), best (300) or fast (any other DPI)
+    tier = renderTierDPIs.get(int(DPI), "fast")
+    if (exportFormat):
+        # Use the tier in the format, or the fast tier for small images e.g. Thumbnails
+        if (exportFormat["tier"]):
+            tier = exportFormat["tier"]
+        elif (exportFormat["width"]) and (exportFormat["width"] * exportFormat["height"] <= int(renderSmallImagePixels)):
+            tier = "fast"
+    # If the print service is busy, drop to a cheaper tier
+    if (tier in degradeTiers) and (tier in renderDegradeTiers):
+        tier = renderDegradeTiers[tier]
+    return tier
+# End of get render tier function
+
+
+# Start of create job context function
+def createJobContext(templateMxd,format):
+    # Create the state for one export - Passed through the export rather than kept in globals so exports don't share state
+    jobContext = {"jobId": str(uuid.uuid1()), "templateMxd": templateMxd, "format": format.lower(), "startTime": time.time(),
+                  "legendOverflow": False, "DPI": None, "jobFolder": None, "degraded": False, "metrics": None}
+    jobContext["metrics"] = {"template": os.path.basename(os.path.dirname(templateMxd)) + "/" + os.path.splitext(os.path.basename(templateMxd))[0],
+                             "format": format.lower(), "stages": {}, "startTime": jobContext["startTime"]}
+    return jobContext
+# End of create job context function
+
+
+# Start of time stage function
+def timeStage(jobContext,stage,stageStartTime):
+    # Add the time since the stage started to the job metrics - Returns the start time of the next stage
+    stageEndTime = time.time()
+    if (enableMetrics == "true"):
+        jobContext["metrics"]["stages"][stage] = round(jobContext["metrics"]["stages"].get(stage, 0) + stageEndTime - stageStartTime, 6)
+    return stageEndTime
+# End of time stage function
+
+
+# Start of set metric function
+def setMetric(jobContext,name,value):
+    if (enableMetrics == "true"):
+        jobContext["metrics"][name] = value
+# End of set metric function
+
+
+# Start of finish metrics function
+def finishMetrics(jobContext,outputFiles):
+    if (enableMetrics == "true"):
+        jobMetrics = jobContext["metrics"]
+        jobMetrics["stages"]["total"] = round(time.time() - jobMetrics["startTime"], 6)
+        jobMetrics["outputBytes"] = sum([os.path.getsize(outputFile) for outputFile in outputFiles])
+        # Write the job metrics as a JSON line
+        if (metricsLogFile):
+            with metricsLock:
+                with open(metricsLogFile, "a") as metricsLog:
+                    metricsLog.write(json.dumps(jobMetrics, sort_keys=True) + "\n")
+        # Worker processes send their metrics back with the job
+        if not workerProcess:
+            updateMetricsHistograms(jobMetrics)
+# End of finish metrics function
+
+
+# Start of update metrics histograms function
+def updateMetricsHistograms(metrics):
+    with metricsLock:
+        # Add the time for each stage to the histogram for the stage and template
+        for stage in metrics["stages"]:
+            histogram = metricsHistograms.setdefault((stage, metrics["template"]), {"buckets": [0] * len(metricsBuckets), "sum": 0.0, "count": 0})
+            for index in range(len(metricsBuckets)):
+                if (metrics["stages"][stage] <= metricsBuckets[index]):
+                    histogram["buckets"][index] = histogram["buckets"][index] + 1
+            histogram["sum"] = histogram["sum"] + metrics["stages"][stage]
+            histogram["count"] = histogram["count"] + 1
+        # Add the output size to the totals for the template and format
+        totals = metricsHistograms.setdefault(("output", metrics["template"], metrics["format"]), {"jobs": 0, "bytes": 0})
+        totals["jobs"] = totals["jobs"] + 1
+        totals["bytes"] = totals["bytes"] + metrics.get("outputBytes", 0)
+        # Add the render time and bytes to the totals for each tier
+        for tier in metrics.get("renderTiers", {}):
+            renderTotals = metricsHistograms.setdefault(("render", tier), {"exports": 0, "seconds": 0.0, "bytes": 0})
+            for name in ["exports","seconds","bytes"]:
+                renderTotals[name] = renderTotals[name] + metrics["renderTiers"][tier][name]
+    # Write the Prometheus text metrics
+    if (metricsFile):
+        tempFile = metricsFile + "." + str(uuid.uuid1()) + ".tmp"
+        with open(tempFile, "w") as metricsOutput:
+            metricsOutput.write(getPrometheusMetrics())
+        if os.path.isfile(metricsFile):
+            os.remove(metricsFile)
+        os.rename(tempFile, metricsFile)
+# End of update metrics histograms function
+
+
+# Start of get Prometheus metrics function
+def getPrometheusMetrics():
+    stageLines = ["# HELP exportwebmap_stage_seconds Time taken by each stage of a web map export",
+                  "# TYPE exportwebmap_stage_seconds histogram"]
+    jobLines = ["# HELP exportwebmap_jobs_total Web maps exported",
+                "# TYPE exportwebmap_jobs_total counter"]
+    byteLines = ["# HELP exportwebmap_output_bytes_total Bytes of output files created",
+                 "# TYPE exportwebmap_output_bytes_total counter"]
+    renderLines = ["# HELP exportwebmap_render_seconds_total Time taken exporting outputs for each rendering tier",
+                   "# TYPE exportwebmap_render_seconds_total counter",
+                   "# HELP exportwebmap_render_bytes_total Bytes of outputs exported for each rendering tier",
+                   "# TYPE exportwebmap_render_bytes_total counter",
+                   "# HELP exportwebmap_renders_total Outputs exported for each rendering tier",
+                   "# TYPE exportwebmap_renders_total counter"]
+    with metricsLock:
+        for key in sorted(metricsHistograms):
+            histogram = metricsHistograms[key]
+            # Output totals for a template and format
+            if (key[0] == "output"):
+                labels = 'template="' + key[1] + '",format="' + key[2] + '"'
+                jobLines.append("exportwebmap_jobs_total{" + labels + "} " + str(histogram["jobs"]))
+                byteLines.append("exportwebmap_output_bytes_total{" + labels + "} " + str(histogram["bytes"]))
+            # Render totals for a tier
+            elif (key[0] == "render"):
+                labels = 'tier="' + key[1] + '"'
+                renderLines.append("exportwebmap_render_seconds_total{" + labels + "} " + str(round(histogram["seconds"], 6)))
+                renderLines.append("exportwebmap_render_bytes_total{" + labels + "} " + str(histogram["bytes"]))
+                renderLines.append("exportwebmap_renders_total{" + labels + "} " + str(histogram["exports"]))
+            # Stage histogram for a template
+            else:
+                labels = 'stage="' + key[0] + '",template="' + key[1] + '"'
+                for index in range(len(metricsBuckets)):
+                    stageLines.append("exportwebmap_stage_seconds_bucket{" + labels + ',le="' + str(metricsBuckets[index]) + '"} ' + str(histogram["buckets"][index]))
+                stageLines.append("exportwebmap_stage_seconds_bucket{" + labels + ',le="+Inf"} ' + str(histogram["count"]))
+                stageLines.append("exportwebmap_stage_seconds_sum{" + labels + "} " + str(round(histogram["sum"], 6)))
+                stageLines.append("exportwebmap_stage_seconds_count{" + labels + "} " + str(histogram["count"]))
+    return "\n".join(stageLines + jobLines + byteLines + renderLines) + "\n"
+# End of get Prometheus metrics function
+
+
+# Start of get output cache key function
+def getOutputCacheKey(webmapObject,agsConnections,templateMxd,format):
+    # Don't cache web maps with a time extent
+    if ("time" in webmapObject.get("mapOptions", {})):
+        return None
+    # Don't cache web maps with time sensitive layers
+    for operationalLayer in webmapObject.get("operationalLayers", []):
+        if (operationalLayer.get("title") in outputCacheExcludeLayers):
+            return None
+
+    # Get the DPI the web map will be printed at
+    DPI = getPrintDPI(webmapObject.get("exportOptions", {}).get("dpi", 96))
+    # Hash the web map with its keys sorted so the same print always gets the same key
+    # The full template path tells apart templates with the same name in different folders, and the server connection keeps prints of secured services apart
+    cacheText = json.dumps(webmapObject, sort_keys=True, separators=(",", ":")) + "|" + os.path.abspath(templateMxd).lower() + "|" + (os.path.abspath(agsConnections).lower() if agsConnections else "") \
+                + "|" + format.lower() + "|" + str(DPI)
+    return hashlib.sha1(cacheText.encode("utf-8")).hexdigest()
+# End of get output cache key function
+
+
+# Start of get output cache folder function
+def getOutputCacheFolder():
+    cacheFolder = outputCacheFolder
+    if not cacheFolder:
+        cacheFolder = os.path.join(arcpy.env.scratchFolder, "ExportWebMapCache")
+    if not os.path.isdir(cacheFolder):
+        try:
+            os.makedirs(cacheFolder)
+        # Another process may have created the folder
+        except OSError:
+            pass
+    return cacheFolder
+# End of get output cache folder function
+
+
+# Start of get cached output function
+def getCachedOutput(cacheKey,fileExtension):
+    # The key covers the full format (resolution, tier and size), the file name only has the extension
+    cachedFile = os.path.join(getOutputCacheFolder(), cacheKey + "." + fileExtension)
+    # If the output is cached and has not expired
+    if os.path.isfile(cachedFile) and ((time.time() - os.path.getmtime(cachedFile)) < float(outputCacheMaxAge)):
+        # Mark the output as recently used
+        os.utime(cachedFile, None)
+        with outputCacheLock:
+            outputCacheStats["hits"] = outputCacheStats["hits"] + 1
+        return cachedFile
+    with outputCacheLock:
+        outputCacheStats["misses"] = outputCacheStats["misses"] + 1
+    return None
+# End of get cached output function
+
+
+# Start of add cached output function
+def addCachedOutput(cacheKey,fileExtension,outputFile):
+    cacheFolder = getOutputCacheFolder()
+    cachedFile = os.path.join(cacheFolder, cacheKey + "." + fileExtension)
+    # Copy to a temporary file then rename so other jobs never read a partly copied output
+    tempFile = cachedFile + "." + str(uuid.uuid1()) + ".tmp"
+    shutil.copyfile(outputFile, tempFile)
+    try:
+        if os.path.isfile(cachedFile):
+            os.remove(cachedFile)
+        os.rename(tempFile, cachedFile)
+    # Another job has cached the same output
+    except OSError:
+        if os.path.isfile(tempFile):
+            os.remove(tempFile)
+    evictCachedOutputs(cacheFolder)
+# End of add cached output function
+
+
+# Start of evict cached outputs function
+def evictCachedOutputs(cacheFolder):
+    # Get the cached outputs, oldest used first
+    cachedFiles = []
+    for fileName in os.listdir(cacheFolder):
+        if not fileName.endswith(".tmp"):
+            filePath = os.path.join(cacheFolder, fileName)
+            cachedFiles.append((os.path.getmtime(filePath), os.path.getsize(filePath), filePath))
+    cachedFiles.sort()
+
+    # Remove expired outputs, then the least recently used outputs until the cache is under the maximum size
+    cacheSize = sum([cachedFile[1] for cachedFile in cachedFiles])
+    for mtime, size, filePath in cachedFiles:
+        if ((time.time() - mtime) < float(outputCacheMaxAge)) and (cacheSize <= float(outputCacheMaxSize) * 1024 * 1024):
+            break
+        try:
+            os.remove(filePath)
+            cacheSize = cacheSize - size
+            with outputCacheLock:
+                outputCacheStats["evictions"] = outputCacheStats["evictions"] + 1
+        # The output may be in use or already removed
+        except OSError:
+            pass
+# End of evict cached outputs function
+
+
+# Start of get job scratch folder function
+def getJobScratchFolder():
+    # If not managing the scratch space, use the scratch folder
+    if (enableScratchManager != "true"):
+        return arcpy.env.scratchFolder
+    # Create a folder for the job - Job folders are split into 256 sub folders to keep folders small
+    jobID = uuid.uuid1().hex
+    jobFolder = os.path.join(arcpy.env.scratchFolder, "ExportWebMapJobs", jobID[:2], jobID)
+    os.makedirs(jobFolder)
+    return jobFolder
+# End of get job scratch folder function
+
+
+# Start of deliver job scratch function
+def deliverJobScratch(jobFolder):
+    global scratchJobs
+    if (enableScratchManager != "true"):
+        return
+    # Mark the job outputs as delivered and record the size of the job
+    open(os.path.join(jobFolder, ".delivered"), "w").close()
+    jobBytes = getFolderSize(jobFolder)
+    if (scratchJobs is None):
+        scanScratch()
+    with scratchLock:
+        scratchJobs[jobFolder] = jobBytes
+    enforceScratchQuota(jobFolder)
+# End of deliver job scratch function
+
+
+# Start of enforce scratch quota function
+def enforceScratchQuota(keepJobFolder=None):
+    with scratchLock:
+        # Remove the oldest delivered jobs until under the quota - The newest job and the job just delivered are kept so their outputs can be returned
+        scratchBytes = sum(scratchJobs.values())
+        for jobFolder in list(scratchJobs.keys())[:-1]:
+            if (scratchBytes <= float(scratchQuota) * 1024 * 1024):
+                break
+            if (jobFolder == keepJobFolder):
+                continue
+            jobBytes = scratchJobs.pop(jobFolder)
+            shutil.rmtree(jobFolder, True)
+            scratchBytes = scratchBytes - jobBytes
+            scratchStats["evictions"] = scratchStats["evictions"] + 1
+# End of enforce scratch quota function
+
+
+# Start of scan scratch function
+def scanScratch():
+    global scratchJobs
+    # Get the delivered jobs and remove the folders of jobs that didn't finish
+    deliveredJobs = []
+    scratchRoot = os.path.join(arcpy.env.scratchFolder, "ExportWebMapJobs")
+    if os.path.isdir(scratchRoot):
+        for shardName in os.listdir(scratchRoot):
+            shardFolder = os.path.join(scratchRoot, shardName)
+            for jobID in os.listdir(shardFolder):
+                jobFolder = os.path.join(shardFolder, jobID)
+                try:
+                    deliveredFile = os.path.join(jobFolder, ".delivered")
+                    if os.path.isfile(deliveredFile):
+                        deliveredJobs.append((os.path.getmtime(deliveredFile), jobFolder, getFolderSize(jobFolder)))
+                    elif ((time.time() - os.path.getmtime(jobFolder)) > float(scratchReapAge)):
+                        shutil.rmtree(jobFolder, True)
+                        scratchStats["reaped"] = scratchStats["reaped"] + 1
+                # The job folder may have been removed by another process
+                except OSError:
+                    pass
+    deliveredJobs.sort()
+    with scratchLock:
+        scratchJobs = collections.OrderedDict([(jobFolder, jobBytes) for deliveredTime, jobFolder, jobBytes in deliveredJobs])
+    enforceScratchQuota()
+# End of scan scratch function
+
+
+# Start of start scratch reaper function
+def startScratchReaper():
+    if (enableScratchManager != "true"):
+        return
+    # Check the scratch space in the background - Picks up jobs from worker processes and jobs that didn't finish
+    reaperThread = threading.Thread(target=runScratchReaper)
+    reaperThread.daemon = True
+    reaperThread.start()
+# End of start scratch reaper function
+
+
+# Start of run scratch reaper function
+def runScratchReaper():
+    while True:
+        try:
+            scanScratch()
+        except Exception as e:
+            printMessage("Scratch space check failed - " + str(getErrorMessage(e)),"warning")
+        time.sleep(float(scratchReapInterval))
+# End of run scratch reaper function
+
+
+# Start of get scratch stats function
+def getScratchStats():
+    with scratchLock:
+        jobs = scratchJobs or {}
+        return {"deliveredJobs": len(jobs), "bytes": sum(jobs.values()), "quotaBytes": int(float(scratchQuota) * 1024 * 1024),
+                "evictions": scratchStats["evictions"], "reaped": scratchStats["reaped"]}
+# End of get scratch stats function
+
+
+# Start of get folder size function
+def getFolderSize(folder):
+    folderBytes = 0
+    for fileName in os.listdir(folder):
+        folderBytes = folderBytes + os.path.getsize(os.path.join(folder, fileName))
+    return folderBytes
+# End of get folder size function
+
+
+# Start of batch function
+def batchFunction(webmapJSONSource,agsConnections,layoutTemplatesFolder,layoutTemplate,format,manifestFile): # Export many web maps in one process - webmapJSONSource is a JSON lines file or a folder of .json files
+    importArcpy()
+    # Get the requested map document - Shared by all jobs in the batch
+    templateMxd = os.path.join(layoutTemplatesFolder, layoutTemplate + '.mxd')
+
+    # Register the templates once for all jobs in the batch
+    loadTemplates(layoutTemplatesFolder)
+    startScratchReaper()
+
+    printMessage("Exporting web maps in batch from " + webmapJSONSource + "...","info")
+    manifest = {"template": templateMxd, "format": format, "jobs": []}
+    batchStartTime = time.time()
+    # If exporting with a pool of worker processes
+    if (int(batchWorkers) > 1):
+        manifest["jobs"] = runBatchPool(readWebMapJobs(webmapJSONSource),agsConnections,templateMxd,format)
+    else:
+        # For each web map in the source - Read one at a time so large batches are not loaded into memory
+        for jobName, webmapJSON in readWebMapJobs(webmapJSONSource):
+            manifest["jobs"].append(runBatchJob(jobName,webmapJSON,agsConnections,templateMxd,format))
+    manifest["seconds"] = round(time.time() - batchStartTime,3)
+    manifest["succeeded"] = len([job for job in manifest["jobs"] if job["status"] == "success"])
+    manifest["failed"] = len(manifest["jobs"]) - manifest["succeeded"]
+    if (enableOutputCache == "true"):
+        manifest["outputCache"] = outputCacheStats
+    manifest["arcpyImportSeconds"] = startupTimes.get("arcpySeconds")
+    if (enableScratchManager == "true"):
+        manifest["scratch"] = getScratchStats()
+
+    # Write the manifest of outputs
+    if not manifestFile:
+        manifestFile = os.path.join(arcpy.env.scratchFolder, 'Batch_{}.{}'.format(str(uuid.uuid1()), "json"))
+    with open(manifestFile, "w") as manifestOutput:
+        json.dump(manifest, manifestOutput, indent=2)
+    printMessage("Exported " + str(manifest["succeeded"]) + " of " + str(len(manifest["jobs"])) + " web maps in " + str(manifest["seconds"]) + " seconds...","info")
+    return manifestFile
+# End of batch function
+
+
+# Start of run batch job function
+def runBatchJob(jobName,webmapJSON,agsConnections,templateMxd,format,degradeTiers=[]):
+    jobStartTime = time.time()
+    job = {"job": jobName, "output": None, "status": "success", "error": None}
+    importArcpy()
+    # Worker processes return their output cache counts for the main process to add up
+    if (workerProcess):
+        with outputCacheLock:
+            cacheCounts = dict(outputCacheStats)
+    try:
+        jobContext = createJobContext(templateMxd,format)
+        job["output"] = exportWebMap(webmapJSON,agsConnections,templateMxd,format,degradeTiers,jobContext)
+        if (enableMetrics == "true"):
+            job["metrics"] = jobContext["metrics"]
+        # Record if the export was dropped to a cheaper rendering tier
+        if (jobContext["degraded"]):
+            job["degraded"] = True
+    # If arcpy error - Record it against the job and carry on with the batch
+    except arcpy.ExecuteError:
+        job["status"] = "error"
+        job["error"] = arcpy.GetMessages(2)
+    # If python error - Record it against the job and carry on with the batch
+    except Exception as e:
+        job["status"] = "error"
+        job["error"] = str(getErrorMessage(e))
+    if (job["error"]):
+        printMessage(jobName + " - " + job["error"],"warning")
+        # Email the error - Worker processes return the error for the main process to email
+        if (sendErrorEmail == "true") and not (workerProcess):
+            queueEmail(jobName + " - " + job["error"])
+    if (workerProcess):
+        with outputCacheLock:
+            job["outputCache"] = dict([(name, outputCacheStats[name] - cacheCounts[name]) for name in outputCacheStats])
+    job["seconds"] = round(time.time() - jobStartTime,3)
+    return job
+# End of run batch job function
+
+
+# Start of run batch pool function
+def runBatchPool(webmapJobs,agsConnections,templateMxd,format):
+    pool = createWorkerPool()
+    jobs = []
+    pendingJobs = []
+    timedOut = False
+    try:
+        for jobName, webmapJSON in webmapJobs:
+            # If the workers are busy and the queue is full, wait for the oldest job before adding another
+            if (len(pendingJobs) >= int(batchWorkers) + int(batchQueueSize)):
+                job, jobTimedOut = waitForBatchJob(pendingJobs.pop(0))
+                jobs.append(job)
+                timedOut = timedOut or jobTimedOut
+            pendingJobs.append(submitBatchJob(pool,jobName,(jobName,webmapJSON,agsConnections,templateMxd,format)))
+        # Wait for the remaining jobs
+        while pendingJobs:
+            job, jobTimedOut = waitForBatchJob(pendingJobs.pop(0))
+            jobs.append(job)
+            timedOut = timedOut or jobTimedOut
+    finally:
+        # If a job timed out its worker may never finish, so stop the workers rather than waiting on them
+        if (timedOut) and (batchThreads != "true"):
+            pool.terminate()
+            pool.join()
+        # Threads can't be stopped, so leave a worker thread that timed out to finish in the background
+        elif (timedOut):
+            pool.close()
+        else:
+            pool.close()
+            pool.join()
+    return jobs
+# End of run batch pool function
+
+
+# Start of create worker pool function
+def createWorkerPool():
+    global workerStarts
+    # If exporting on threads, the workers share arcpy and the caches in this process
+    if (batchThreads == "true"):
+        printMessage("Starting " + str(batchWorkers) + " worker threads...","info")
+        workerStarts = Queue.Queue()
+        return multiprocessing.pool.ThreadPool(int(batchWorkers))
+
+    # If running inside ArcGIS, worker processes need to be started with python rather than the ArcGIS executable
+    if (os.path.basename(sys.executable).lower() in ["arcgispro.exe","arcmap.exe","arccatalog.exe"]):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))
+    printMessage("Starting " + str(batchWorkers) + " worker processes...","info")
+    # Worker processes report when they start each job so the job timeout runs from then
+    workerStarts = multiprocessing.Queue()
+    return multiprocessing.Pool(int(batchWorkers), initializer=initialiseWorker, initargs=(workerStarts,))
+# End of create worker pool function
+
+
+# Start of submit batch job function
+def submitBatchJob(pool,jobName,jobArguments):
+    # Add the job to the pool - The job ID matches the job to the worker that starts it
+    jobId = uuid.uuid1().hex
+    return (jobName, pool.apply_async(runWorkerJob, (jobArguments,jobId)), time.time(), jobId)
+# End of submit batch job function
+
+
+# Start of get job start function
+def getJobStart(jobId):
+    # Get the jobs the workers have started since last checked
+    with jobStartsLock:
+        try:
+            while True:
+                startedJobId, processId, startTime = workerStarts.get_nowait()
+                jobStarts[startedJobId] = {"processId": processId, "startTime": startTime}
+        except Queue.Empty:
+            pass
+        return jobStarts.get(jobId)
+# End of get job start function
+
+
+# Start of wait for batch job function
+def waitForBatchJob(pendingJob):
+    jobName, asyncResult, submitTime, jobId = pendingJob
+    # Wait for the job - The timeout runs from when a worker starts the job, so jobs waiting behind other jobs are not timed out
+    while True:
+        jobStart = getJobStart(jobId)
+        if (jobStart) and (time.time() >= jobStart["startTime"] + float(batchJobTimeout)) and not (asyncResult.ready()):
+            break
+        try:
+            if (jobStart):
+                job = asyncResult.get(max(jobStart["startTime"] + float(batchJobTimeout) - time.time(), 0))
+            # If the job is waiting for a worker, check again shortly for when it starts
+            else:
+                job = asyncResult.get(1)
+        except multiprocessing.TimeoutError:
+            continue
+        with jobStartsLock:
+            jobStarts.pop(jobId, None)
+        # Add the metrics from the worker process to the metrics for this process - Worker threads have already added them
+        if ("metrics" in job) and (batchThreads != "true"):
+            updateMetricsHistograms(job["metrics"])
+        # Add the output cache counts from the worker process to the counts for this process
+        if ("outputCache" in job):
+            with outputCacheLock:
+                for name, count in job.pop("outputCache").items():
+                    outputCacheStats[name] = outputCacheStats[name] + count
+        # Email the errors from worker processes - Worker threads have already queued them
+        if (job["error"]) and (sendErrorEmail == "true") and (batchThreads != "true"):
+            queueEmail(jobName + " - " + job["error"])
+        return job, False
+
+    # If the job is taking too long - Record it against the job and carry on with the batch
+    with jobStartsLock:
+        jobStarts.pop(jobId, None)
+    printMessage(jobName + " - Timed out after " + str(batchJobTimeout) + " seconds","warning")
+    job = {"job": jobName, "output": None, "status": "error", "error": "Timed out after " + str(batchJobTimeout) + " seconds"}
+    job["seconds"] = round(time.time() - submitTime,3)
+    # Stop the worker process so it doesn't hold a worker until the batch ends - The pool starts a new worker process in its place
+    if (batchThreads != "true"):
+        try:
+            os.kill(jobStart["processId"], signal.SIGTERM)
+        # The worker process may have just finished
+        except OSError:
+            pass
+    if (sendErrorEmail == "true"):
+        queueEmail(jobName + " - " + job["error"])
+    return job, True
+# End of wait for batch job function
+
+
+# Start of initialise worker function
+def initialiseWorker(startQueue):
+    global workerProcess, workerStarts
+    workerProcess = True
+    workerStarts = startQueue
+    # Each worker process imports arcpy once and keeps it loaded for all of its jobs
+    importArcpy()
+    # Route requests through the proxy or the tile cache running in the main process
+    if (enableProxy == "true") or (enableTileCache == "true"):
+        installProxy()
+# End of initialise worker function
+
+
+# Start of run worker job function
+def runWorkerJob(jobArguments,jobId):
+    # Let the main process know the job has started
+    workerStarts.put((jobId, os.getpid(), time.time()))
+    # Export a batch job in a worker process - Errors are caught and returned in the job
+    return runBatchJob(*jobArguments)
+# End of run worker job function
+
+
+# Start of service function
+def serviceFunction(agsConnections,layoutTemplatesFolder): # Run a HTTP print service - POST web map JSON to /jobs, then poll /jobs/<job ID> and get the file from /jobs/<job ID>/output
+    # Register the templates the service can print with
+    importArcpy()
+    loadTemplates(layoutTemplatesFolder)
+    startScratchReaper()
+
+    printService = {"agsConnections": agsConnections, "layoutTemplatesFolder": layoutTemplatesFolder,
+                    "jobQueue": Queue.Queue(int(serviceQueueSize)), "jobs": collections.OrderedDict(), "jobsLock": threading.Lock(), "pool": None}
+    # If exporting with a pool of worker processes, have a thread waiting on each worker - Otherwise export one job at a time in this process
+    if (int(batchWorkers) > 1):
+        printService["pool"] = createWorkerPool()
+    for worker in range(max(int(batchWorkers), 1)):
+        workerThread = threading.Thread(target=runServiceWorker, args=(printService,))
+        workerThread.daemon = True
+        workerThread.start()
+
+    server = PrintServiceServer((serviceHost, int(servicePort)), PrintServiceHandler)
+    server.printService = printService
+    printMessage("Print service running on http://" + serviceHost + ":" + str(servicePort) + "/jobs...","info")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if (printService["pool"]):
+            printService["pool"].terminate()
+# End of service function
+
+
+# Start of run service worker function
+def runServiceWorker(printService):
+    while True:
+        job = printService["jobQueue"].get()
+        job["status"] = "running"
+        # If the service is busy, degrade fast jobs and all low priority jobs to cheaper rendering tiers
+        degradeTiers = []
+        if (printService["jobQueue"].qsize() >= int(renderDegradeQueueLength)):
+            degradeTiers = list(renderDegradeTiers.keys()) if (job["priority"] == "low") else ["fast"]
+        jobArguments = (job["jobId"],job["webmapJSON"],printService["agsConnections"],job["templateMxd"],job["format"],degradeTiers)
+        # Export the job in a worker process or in this process
+        if (printService["pool"]):
+            result, timedOut = waitForBatchJob(submitBatchJob(printService["pool"],job["jobId"],jobArguments))
+        else:
+            result = runBatchJob(*jobArguments)
+        # Update the job status and remove the web map as it is no longer needed
+        with printService["jobsLock"]:
+            job.update(result)
+            del job["webmapJSON"]
+            # Remove the oldest finished jobs once over the job history
+            finishedJobs = [jobId for jobId in printService["jobs"] if printService["jobs"][jobId]["status"] in ["success","error","expired"]]
+            for jobId in finishedJobs[:max(len(finishedJobs) - int(serviceJobHistory), 0)]:
+                del printService["jobs"][jobId]
+        printService["jobQueue"].task_done()
+# End of run service worker function
+
+
+# Start of print service server class
+class PrintServiceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Handle each request on its own thread so status requests are not held up by new jobs
+    daemon_threads = True
+# End of print service server class
+
+
+# Start of print service handler class
+class PrintServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        printService = self.server.printService
+        if (self.path.rstrip("/") != "/jobs"):
+            return self.sendJSON(404, {"error": "Not found"})
+        # Get the job parameters - {"webmapJSON": ..., "layoutTemplate": ..., "format": ...}
+        try:
+            parameters = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            webmapJSON = parameters["webmapJSON"]
+            if not isinstance(webmapJSON, (str, type(u""))):
+                webmapJSON = json.dumps(webmapJSON)
+            # Normalise the path so "Dynamic Legend/A4 Landscape" matches the registered template on Windows
+            templateMxd = os.path.normpath(os.path.join(printService["layoutTemplatesFolder"], parameters["layoutTemplate"] + ".mxd"))
+            format = parameters.get("format", "pdf").lower()
+            parseFormats(format)
+            priority = parameters.get("priority", "normal").lower()
+            if (priority not in ["normal","low"]):
+                raise ValueError("Priority not supported - " + priority)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self.sendJSON(400, {"error": "Invalid job parameters - " + str(getErrorMessage(e))})
+        # Only print with the registered templates
+        if (templateMxd not in templateCache):
+            return self.sendJSON(400, {"error": "Layout template not found - " + parameters["layoutTemplate"]})
+
+        job = {"jobId": str(uuid.uuid1()), "status": "queued", "webmapJSON": webmapJSON, "templateMxd": templateMxd, "format": format, "priority": priority}
+        with printService["jobsLock"]:
+            printService["jobs"][job["jobId"]] = job
+        # Add the job to the queue - If the queue is full, tell the client to try again later
+        try:
+            printService["jobQueue"].put_nowait(job)
+        except Queue.Full:
+            with printService["jobsLock"]:
+                del printService["jobs"][job["jobId"]]
+            return self.sendJSON(429, {"error": "Too many jobs waiting, try again later"}, {"Retry-After": "5"})
+        self.sendJSON(202, {"jobId": job["jobId"], "status": job["status"]}, {"Location": "/jobs/" + job["jobId"]})
+
+    def do_GET(self):
+        printService = self.server.printService
+        path = self.path.strip("/").split("/")
+        # Get the metrics
+        if (path == ["metrics"]):
+            body = getPrometheusMetrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        # Get the scratch space usage
+        if (path == ["scratch"]):
+            return self.sendJSON(200, getScratchStats())
+        # Get the tile cache stats
+        if (path == ["tilecache"]):
+            return self.sendJSON(200, getTileCacheStats())
+        if (len(path) < 2) or (path[0] != "jobs"):
+            return self.sendJSON(404, {"error": "Not found"})
+        with printService["jobsLock"]:
+            job = printService["jobs"].get(path[1])
+            if (job):
+                job = dict([(key, value) for key, value in job.items() if key not in ["webmapJSON","templateMxd"]])
+        if not job:
+            return self.sendJSON(404, {"error": "Job not found"})
+
+        # Get the job status
+        if (len(path) == 2):
+            return self.sendJSON(200, job)
+        # Get the output file - /jobs/<job ID>/output/<format> if more than one format
+        if (len(path) in [3,4]) and (path[2] == "output"):
+            if (job["status"] != "success"):
+                return self.sendJSON(409, {"error": "Job is " + job["status"]})
+            outputFile = job["output"]
+            if isinstance(outputFile, dict):
+                formatKey = unquote(path[3]) if (len(path) == 4) else list(outputFile.keys())[0]
+                if (formatKey not in outputFile):
+                    return self.sendJSON(404, {"error": "Format not found - " + formatKey})
+                outputFile = outputFile[formatKey]["output"]
+            # If the output has been removed to keep the scratch space under the quota, mark the job as expired
+            try:
+                outputContent = open(outputFile, "rb")
+            except (OSError, IOError):
+                with printService["jobsLock"]:
+                    if (path[1] in printService["jobs"]):
+                        printService["jobs"][path[1]]["status"] = "expired"
+                return self.sendJSON(410, {"error": "Job output has expired"})
+            contentTypes = {".pdf": "application/pdf", ".jpg": "image/jpeg", ".png": "image/png"}
+            with outputContent:
+                self.send_response(200)
+                self.send_header("Content-Type", contentTypes.get(os.path.splitext(outputFile)[1], "application/octet-stream"))
+                self.send_header("Content-Length", str(os.fstat(outputContent.fileno()).st_size))
+                self.end_headers()
+                shutil.copyfileobj(outputContent, self.wfile)
+            return
+        self.sendJSON(404, {"error": "Not found"})
+
+    def sendJSON(self, status, response, headers={}):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header in headers:
+            self.send_header(header, headers[header])
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests are not printed as messages - Polling would fill up the output
+        pass
+# End of print service handler class
+
+
+# Start of start tile cache function
+def startTileCache():
+    global enableTileCache
+    tileCache["folder"] = tileCacheFolder or os.path.join(tempfile.gettempdir(), "ExportWebMapTileCache")
+    if not os.path.isdir(tileCache["folder"]):
+        os.makedirs(tileCache["folder"])
+    # Only one process runs the tile cache on the port, so one process manages the cached responses and keeps them under the maximum size
+    try:
+        server = TileCacheServer((tileCacheHost, int(tileCachePort)), TileCacheHandler)
+    except socket.error:
+        # If another process is running the tile cache, send requests to it and take over if it stops
+        if isTileCacheRunning():
+            printMessage("Using the tile cache running on http://" + tileCacheHost + ":" + str(tileCachePort) + "...","info")
+            standbyThread = threading.Thread(target=runTileCacheStandby)
+            standbyThread.daemon = True
+            standbyThread.start()
+        # Else the port is used by something else
+        else:
+            enableTileCache = "false"
+            printMessage("Port " + str(tileCachePort) + " is in use, continuing without the tile cache...","warning")
+        return None
+    serveTileCache(server)
+    return server
+# End of start tile cache function
+
+
+# Start of serve tile cache function
+def serveTileCache(server):
+    # Get the responses already cached on disk, oldest used first
+    cachedTiles = []
+    for fileName in os.listdir(tileCache["folder"]):
+        filePath = os.path.join(tileCache["folder"], fileName)
+        if fileName.endswith(".json") and os.path.isfile(filePath[:-5] + ".tile"):
+            try:
+                with open(filePath) as tileContent:
+                    cachedTiles.append((os.path.getmtime(filePath[:-5] + ".tile"), fileName[:-5], json.load(tileContent)))
+            # Skip responses that were being written when the cache was last stopped
+            except (ValueError, OSError, IOError):
+                pass
+    cachedTiles.sort()
+    with tileCacheLock:
+        for mtime, tileKey, tile in cachedTiles:
+            tileCache["entries"][tileKey] = tile
+            tileCache["bytes"] = tileCache["bytes"] + tile["bytes"]
+    evictTiles()
+
+    # Handle the requests in the background
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+    printMessage("Tile cache running on http://" + tileCacheHost + ":" + str(tileCachePort) + " with " + str(len(tileCache["entries"])) + " cached responses...","info")
+# End of serve tile cache function
+
+
+# Start of is tile cache running function
+def isTileCacheRunning():
+    # Check the port is being used by a tile cache
+    try:
+        connection = httplib.HTTPConnection(tileCacheHost, int(tileCachePort), timeout=5)
+        try:
+            connection.request("GET", "/stats")
+            response = connection.getresponse()
+            return (response.status == 200) and ("hitRatio" in json.loads(response.read().decode("utf-8")))
+        finally:
+            connection.close()
+    except Exception:
+        return False
+# End of is tile cache running function
+
+
+# Start of run tile cache standby function
+def runTileCacheStandby():
+    # Start the tile cache in this process if the process running it stops
+    while True:
+        time.sleep(float(tileCacheStandbyInterval))
+        try:
+            server = TileCacheServer((tileCacheHost, int(tileCachePort)), TileCacheHandler)
+        except socket.error:
+            continue
+        serveTileCache(server)
+        return
+# End of run tile cache standby function
+
+
+# Start of install proxy function
+def installProxy():
+    # Python version check
+    if sys.version_info[0] >= 3:
+        # Python 3.x
+        import urllib.request as urllib2
+    else:
+        # Python 2.x
+        import urllib2
+    proxies = {}
+    if (enableProxy == "true"):
+        proxies[requestProtocol] = proxyURL
+    # If caching tiles, send http requests to the tile cache - The tile cache sends them on to the proxy
+    if (enableTileCache == "true"):
+        proxies["http"] = "http://" + tileCacheHost + ":" + str(tileCachePort)
+        os.environ["http_proxy"] = proxies["http"]
+    # Setup the proxy
+    proxy = urllib2.ProxyHandler(proxies)
+    openURL = urllib2.build_opener(proxy)
+    # Install the proxy
+    urllib2.install_opener(openURL)
+# End of install proxy function
+
+
+# Start of get tile function
+def getTile(url,requestHeaders):
+    # Get a response from the cache, or from the server if it is not cached or has expired - Returns the status, headers, body and where it came from
+    tileKey = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    # Requests with credentials only share a fetch with requests with the same credentials
+    credentials = [name.lower() + ":" + value for name, value in requestHeaders if name.lower() in ["authorization","cookie"]]
+    fetchKey = tileKey + ("|" + hashlib.sha1("|".join(sorted(credentials)).encode("utf-8")).hexdigest() if (credentials) else "")
+    with tileCacheLock:
+        tileCacheStats["requests"] = tileCacheStats["requests"] + 1
+        tile = tileCache["entries"].get(tileKey)
+    # If the response is cached and hasn't expired
+    if (tile) and (tile["expires"] > time.time()):
+        body = readTile(tileKey)
+        if (body is not None):
+            with tileCacheLock:
+                # Move the response to the end of the cache as the most recently used
+                if (tileKey in tileCache["entries"]):
+                    tileCache["entries"][tileKey] = tileCache["entries"].pop(tileKey)
+                tileCacheStats["hits"] = tileCacheStats["hits"] + 1
+                tileCacheStats["bytesSaved"] = tileCacheStats["bytesSaved"] + len(body)
+            return tile["status"], tile["headers"], body, "HIT"
+
+    # If the same request is already being fetched, wait for it rather than fetching it again
+    with tileCacheLock:
+        fetch = tileCache["fetches"].get(fetchKey)
+        waitForFetch = fetch is not None
+        if (waitForFetch):
+            tileCacheStats["collapsed"] = tileCacheStats["collapsed"] + 1
+        else:
+            fetch = {"event": threading.Event(), "response": None}
+            tileCache["fetches"][fetchKey] = fetch
+    if (waitForFetch):
+        fetch["event"].wait()
+        if (fetch["response"] is None):
+            raise IOError("Request failed - " + url)
+        with tileCacheLock:
+            tileCacheStats["bytesSaved"] = tileCacheStats["bytesSaved"] + len(fetch["response"][2])
+        return fetch["response"] + ("COLLAPSED",)
+
+    try:
+        # If the expired response can be checked, only get it again if it has changed
+        headers = dict([(name, value) for name, value in requestHeaders if name.lower() not in ["if-none-match","if-modified-since"]])
+        conditionalHeaders = dict(headers)
+        if (tile) and (tile.get("etag")):
+            conditionalHeaders["If-None-Match"] = tile["etag"]
+        if (tile) and (tile.get("lastModified")):
+            conditionalHeaders["If-Modified-Since"] = tile["lastModified"]
+        status, responseHeaders, body = fetchUpstream("GET", url, conditionalHeaders, None)
+        upstreamBytes = len(body)
+
+        # If not changed, use the cached response for longer
+        if (status == 304) and (tile):
+            cachedBody = readTile(tileKey)
+            if (cachedBody is not None):
+                # Update the cached headers with the headers sent with the not changed response
+                updatedHeaders = set([name.lower() for name, value in responseHeaders])
+                tile["headers"] = [[name, value] for name, value in tile["headers"] if name.lower() not in updatedHeaders] + responseHeaders
+                tile["expires"] = getTileExpiry(tile["headers"]) or time.time()
+                writeTile(tileKey,tile,None)
+                with tileCacheLock:
+                    tileCacheStats["upstreamBytes"] = tileCacheStats["upstreamBytes"] + upstreamBytes
+                    tileCacheStats["revalidated"] = tileCacheStats["revalidated"] + 1
+                    tileCacheStats["bytesSaved"] = tileCacheStats["bytesSaved"] + len(cachedBody)
+                fetch["response"] = (tile["status"], tile["headers"], cachedBody)
+                return fetch["response"] + ("REVALIDATED",)
+            # The cached response has been removed so get all of it again
+            status, responseHeaders, body = fetchUpstream("GET", url, headers, None)
+            upstreamBytes = upstreamBytes + len(body)
+
+        # Cache the response if it can be cached - Responses that vary by request header are not cached as the cache is keyed on the URL
+        expires = getTileExpiry(responseHeaders)
+        headerNames = dict([(name.lower(), value) for name, value in responseHeaders])
+        cacheable = (status == 200) and (expires is not None) and ("set-cookie" not in headerNames) and ("vary" not in headerNames)
+        # Only cache responses to requests with credentials if the response says it can be shared
+        if (credentials):
+            cacheControl = [directive.strip().partition("=")[0] for directive in headerNames.get("cache-control", "").lower().split(",")]
+            cacheable = cacheable and (("public" in cacheControl) or ("s-maxage" in cacheControl))
+        if (cacheable):
+            writeTile(tileKey,{"url": url, "status": status, "headers": responseHeaders, "bytes": len(body), "expires": expires,
+                               "etag": headerNames.get("etag"), "lastModified": headerNames.get("last-modified")},body)
+        with tileCacheLock:
+            tileCacheStats["upstreamBytes"] = tileCacheStats["upstreamBytes"] + upstreamBytes
+            tileCacheStats["misses"] = tileCacheStats["misses"] + 1
+            if not (cacheable):
+                tileCacheStats["uncacheable"] = tileCacheStats["uncacheable"] + 1
+        fetch["response"] = (status, responseHeaders, body)
+        return fetch["response"] + ("MISS",)
+    finally:
+        # Let the requests waiting on this fetch carry on
+        with tileCacheLock:
+            del tileCache["fetches"][fetchKey]
+        fetch["event"].set()
+# End of get tile function
+
+
+# Start of get tile expiry function
+def getTileExpiry(responseHeaders):
+    # Get the time a response expires from the Cache-Control or Expires header - None if it can't be cached
+    headerNames = dict([(name.lower(), value) for name, value in responseHeaders])
+    cacheControl = {}
+    for directive in headerNames.get("cache-control", "").lower().split(","):
+        name, separator, value = directive.strip().partition("=")
+        cacheControl[name] = value.strip('"')
+    if ("no-store" in cacheControl) or ("private" in cacheControl):
+        return None
+    # If the response has to be checked each time, it is only worth caching if it can be checked
+    if ("no-cache" in cacheControl):
+        if ("etag" in headerNames) or ("last-modified" in headerNames):
+            return time.time()
+        return None
+    for name in ["s-maxage","max-age"]:
+        if (cacheControl.get(name, "").isdigit()):
+            return time.time() + int(cacheControl[name])
+    if ("expires" in headerNames):
+        expiryDate = email.utils.parsedate_tz(headerNames["expires"])
+        # An invalid date means the response has already expired
+        return email.utils.mktime_tz(expiryDate) if (expiryDate) else time.time()
+    return time.time() + float(tileCacheDefaultAge)
+# End of get tile expiry function
+
+
+# Start of read tile function
+def readTile(tileKey):
+    # Get the body of a cached response - None if it has been removed
+    try:
+        with open(os.path.join(tileCache["folder"], tileKey + ".tile"), "rb") as tileContent:
+            return tileContent.read()
+    except (OSError, IOError):
+        return None
+# End of read tile function
+
+
+# Start of write tile function
+def writeTile(tileKey,tile,body):
+    # Write the body (if it has changed) and the details of a response to the cache folder
+    tileFile = os.path.join(tileCache["folder"], tileKey)
+    tempFile = tileFile + "." + str(uuid.uuid1()) + ".tmp"
+    if (body is not None):
+        with open(tempFile, "wb") as tileOutput:
+            tileOutput.write(body)
+        if os.path.isfile(tileFile + ".tile"):
+            os.remove(tileFile + ".tile")
+        os.rename(tempFile, tileFile + ".tile")
+    # Else mark the body as used so the cache is in the same order when it is next started
+    else:
+        try:
+            os.utime(tileFile + ".tile", None)
+        # The response may have been removed from the cache
+        except OSError:
+            pass
+    with open(tempFile, "w") as tileOutput:
+        json.dump(tile, tileOutput)
+    if os.path.isfile(tileFile + ".json"):
+        os.remove(tileFile + ".json")
+    os.rename(tempFile, tileFile + ".json")
+
+    # Add the response to the cache, most recently used last
+    with tileCacheLock:
+        cachedTile = tileCache["entries"].pop(tileKey, None)
+        if (cachedTile):
+            tileCache["bytes"] = tileCache["bytes"] - cachedTile["bytes"]
+        tileCache["entries"][tileKey] = tile
+        tileCache["bytes"] = tileCache["bytes"] + tile["bytes"]
+    evictTiles()
+# End of write tile function
+
+
+# Start of evict tiles function
+def evictTiles():
+    # Remove the least recently used responses until the cache is under the maximum size
+    with tileCacheLock:
+        while (tileCache["bytes"] > float(tileCacheMaxSize) * 1024 * 1024) and (tileCache["entries"]):
+            tileKey, tile = tileCache["entries"].popitem(last=False)
+            tileCache["bytes"] = tileCache["bytes"] - tile["bytes"]
+            tileCacheStats["evictions"] = tileCacheStats["evictions"] + 1
+            for extension in [".tile",".json"]:
+                try:
+                    os.remove(os.path.join(tileCache["folder"], tileKey + extension))
+                # The response may be being read
+                except OSError:
+                    pass
+# End of evict tiles function
+
+
+# Start of fetch upstream function
+def fetchUpstream(method,url,headers,body):
+    # Send the request to the server (or the proxy if there is one) on a pooled connection - Returns the status, headers and body
+    urlParts = urlsplit(url)
+    if (enableProxy == "true") and (requestProtocol == "http") and (proxyURL):
+        serverParts = urlsplit(proxyURL if ("://" in proxyURL) else "http://" + proxyURL)
+        path = url
+    else:
+        serverParts = urlParts
+        path = urlParts.path + ("?" + urlParts.query if urlParts.query else "")
+    server = (serverParts.hostname, serverParts.port or 80)
+    headers = dict([(name, value) for name, value in headers.items() if name.lower() not in hopByHopHeaders + ["host"]])
+    headers["Host"] = urlParts.netloc
+
+    for attempt in range(2):
+        # Use an idle connection to the server if there is one
+        with tileCacheLock:
+            idleConnections = tileCache["connections"].setdefault(server, [])
+            connection = idleConnections.pop() if (idleConnections) and (attempt == 0) else None
+        reusedConnection = connection is not None
+        if not connection:
+            connection = httplib.HTTPConnection(server[0], server[1], timeout=60)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            responseBody = response.read()
+        # If an idle connection has been closed by the server, try again on a new connection
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if (reusedConnection):
+                continue
+            raise
+        responseHeaders = [[name, value] for name, value in response.getheaders() if name.lower() not in hopByHopHeaders + ["content-length"]]
+        # Keep the connection open for the next request
+        if (response.getheader("connection", "").lower() == "close") or (response.version < 11):
+            connection.close()
+        else:
+            with tileCacheLock:
+                if (len(idleConnections) < int(tileCacheConnections)):
+                    idleConnections.append(connection)
+                else:
+                    connection.close()
+        return response.status, responseHeaders, responseBody
+# End of fetch upstream function
+
+
+# Start of get tile cache stats function
+def getTileCacheStats():
+    with tileCacheLock:
+        tileStats = dict(tileCacheStats)
+        tileStats["cachedResponses"] = len(tileCache["entries"])
+        tileStats["bytes"] = tileCache["bytes"]
+    tileStats["hitRatio"] = round(float(tileStats["hits"] + tileStats["revalidated"] + tileStats["collapsed"]) / max(tileStats["requests"], 1), 3)
+    return tileStats
+# End of get tile cache stats function
+
+
+# Start of tile cache server class
+class TileCacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Handle each request on its own thread so identical requests can wait on one fetch
+    daemon_threads = True
+    # On Windows reusing the address lets more than one process listen on the port, so only reuse it elsewhere
+    allow_reuse_address = (os.name != "nt")
+# End of tile cache server class
+
+
+# Start of tile cache handler class
+class TileCacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send the headers and body without waiting for the headers to be acknowledged
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        # Get the tile cache stats e.g. http://localhost:8081/stats
+        if (self.path.rstrip("/") == "/stats"):
+            return self.sendResponse(200, [["Content-Type", "application/json"]], json.dumps(getTileCacheStats()).encode("utf-8"))
+        # Only http requests are proxied
+        if not self.path.lower().startswith("http://"):
+            return self.sendResponse(400, [["Content-Type", "text/plain"]], b"Only http requests can be sent to the tile cache")
+        try:
+            status, headers, body, cacheStatus = getTile(self.path, list(self.headers.items()))
+        except Exception as e:
+            return self.sendResponse(502, [["Content-Type", "text/plain"]], str(getErrorMessage(e)).encode("utf-8"))
+        self.sendResponse(status, headers + [["X-Cache", cacheStatus]], body)
+
+    def do_POST(self):
+        # Requests that change data or can't be cached are sent straight to the server e.g. Large export map requests
+        if not self.path.lower().startswith("http://"):
+            return self.sendResponse(400, [["Content-Type", "text/plain"]], b"Only http requests can be sent to the tile cache")
+        try:
+            status, headers, body = fetchUpstream("POST", self.path, dict(self.headers.items()), self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except Exception as e:
+            return self.sendResponse(502, [["Content-Type", "text/plain"]], str(getErrorMessage(e)).encode("utf-8"))
+        with tileCacheLock:
+            tileCacheStats["upstreamBytes"] = tileCacheStats["upstreamBytes"] + len(body)
+        self.sendResponse(status, headers, body)
+
+    def sendResponse(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if (self.command != "HEAD"):
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests are not printed as messages - Every tile would be printed
+        pass
+# End of tile cache handler class
+
+
+# Start of read web map jobs function
+def readWebMapJobs(webmapJSONSource):
+    # If a folder of web map JSON files
+    if os.path.isdir(webmapJSONSource):
+        for fileName in sorted(os.listdir(webmapJSONSource)):
+            if fileName.lower().endswith(".json"):
+                with open(os.path.join(webmapJSONSource, fileName)) as webmapFile:
+                    yield fileName, webmapFile.read()
+    # Else a JSON lines file - One web map per line
+    else:
+        with open(webmapJSONSource) as webmapFile:
+            lineNumber = 0
+            for line in webmapFile:
+                lineNumber = lineNumber + 1
+                if line.strip():
+                    yield os.path.basename(webmapJSONSource) + ":" + str(lineNumber), line.strip()
+# End of read web map jobs function
+
+
+# Start of atlas function
+def atlasFunction(webmapJSON,agsConnections,layoutTemplatesFolder,layoutTemplate,extentsFile,format,outputFile): # Export a web map at each extent in a JSON or CSV file (xmin,ymin,xmax,ymax and optionally scale and name) into a multi-page PDF or a zip of images
+    importArcpy()
+    atlasStartTime = time.time()
+    templateMxd = os.path.join(layoutTemplatesFolder, layoutTemplate + '.mxd')
+    format = format.lower()
+    # Get the format to export - A resolution or rendering tier and an image size can be given as for a single print
+    exportFormats = parseFormats(format)
+    if (len(exportFormats) != 1):
+        raise ValueError("Atlas exports only support one format - " + format)
+    exportFormat = exportFormats[0]
+    extents = readAtlasExtents(extentsFile)
+
+    # Convert the web map once for all the extents - Only remove hidden layers as the scale changes between extents
+    jobContext = createJobContext(templateMxd,format)
+    webmapObject = json.loads(webmapJSON)
+    webmapJSON = prepareWebMapJSON(webmapJSON,webmapObject,jobContext,False)
+    result = convertWebMap(webmapJSON,agsConnections,templateMxd)
+    mxd = result.mapDocument
+    tier = getRenderTier(result.DPI,exportFormat)
+    renderSettings = renderTiers[tier]
+    resolution = exportFormat["resolution"] or renderSettings["resolution"]
+    layoutElements = listLayoutElements(mxd)
+    templateInfo = getTemplateInfo(templateMxd,mxd,layoutElements)
+    df = arcpy.mapping.ListDataFrames(mxd, 'Webmap')[0]
+    legend = None
+    if (templateInfo["legendName"]):
+        legend = layoutElements["LEGEND_ELEMENT"][0]
+        legendPosition = (legend.elementPositionX, legend.elementPositionY)
+        # Keep the size and position of the data frame so it can be put back after being widened for a sheet without a legend
+        dataFrameElement = layoutElements["DATAFRAME_ELEMENT"][0]
+        dataFrameLayout = (dataFrameElement.elementHeight, dataFrameElement.elementWidth, dataFrameElement.elementPositionX, dataFrameElement.elementPositionY)
+        dataFrameWidened = False
+    layerIndex = reconcileLayers(mxd,df,legend)
+
+    jobFolder = getJobScratchFolder()
+    jobContext["jobFolder"] = jobFolder
+    if not outputFile:
+        outputFile = os.path.join(jobFolder, 'Atlas_{}.{}'.format(str(uuid.uuid1()), "pdf" if (exportFormat["format"] == "pdf") else "zip"))
+    printMessage("Exporting " + str(len(extents)) + " pages (" + tier + " tier)...","info")
+    if (exportFormat["format"] == "pdf"):
+        outputDocument = arcpy.mapping.PDFDocumentCreate(outputFile)
+    else:
+        outputDocument = zipfile.ZipFile(outputFile, "w", zipfile.ZIP_STORED)
+
+    try:
+        for index in range(len(extents)):
+            extent = extents[index]
+            # If the data frame was widened for the last sheet, put it back before fitting the extent
+            if (legend) and (dataFrameWidened):
+                reSizeElement(dataFrameElement,*dataFrameLayout)
+                dataFrameWidened = False
+            # Move the map to the extent and scale
+            df.extent = arcpy.Extent(float(extent["xmin"]), float(extent["ymin"]), float(extent["xmax"]), float(extent["ymax"]))
+            if (extent.get("scale")):
+                df.scale = float(extent["scale"])
+
+            # If there are no legend items visible at this scale, remove the legend by moving it off the page
+            if (legend):
+                if (countLegendItems(layerIndex["legendIndex"],df.scale) == 0):
+                    legend.elementPositionX = -5000
+                    legend.elementPositionY = -5000
+                    # Resize data frame element to fill the space left by the legend, as for a single print
+                    reSizeElement(dataFrameElement,dataFrameElement.elementHeight,templateInfo["pageWidth"]-2,dataFrameElement.elementPositionX,dataFrameElement.elementPositionY)
+                    dataFrameWidened = True
+                else:
+                    legend.elementPositionX, legend.elementPositionY = legendPosition
+
+            # Export the page and add it to the output
+            pageName = str(extent.get("name") or (index + 1))
+            pageFile = os.path.join(jobFolder, 'Page_{}.{}'.format(str(uuid.uuid1()), exportFormat["format"]))
+            try:
+                if (exportFormat["format"] == "pdf"):
+                    arcpy.mapping.ExportToPDF(mxd, pageFile, resolution=resolution, image_quality=renderSettings["pdfImageQuality"])
+                    outputDocument.appendPages(pageFile)
+                # If an image size has been given, export the data frame at that size
+                elif (exportFormat["width"]):
+                    if (exportFormat["format"] == "jpg"):
+                        arcpy.mapping.ExportToJPEG(mxd, pageFile, df, df_export_width=exportFormat["width"], df_export_height=exportFormat["height"], resolution=resolution, jpeg_quality=renderSettings["jpegQuality"])
+                    else:
+                        arcpy.mapping.ExportToPNG(mxd, pageFile, df, df_export_width=exportFormat["width"], df_export_height=exportFormat["height"], resolution=resolution, color_mode=renderSettings["pngColorMode"])
+                    outputDocument.write(pageFile, pageName + "." + exportFormat["format"])
+                elif (exportFormat["format"] == "jpg"):
+                    arcpy.mapping.ExportToJPEG(mxd, pageFile, resolution=resolution, jpeg_quality=renderSettings["jpegQuality"])
+                    outputDocument.write(pageFile, pageName + ".jpg")
+                else:
+                    arcpy.mapping.ExportToPNG(mxd, pageFile, resolution=resolution, color_mode=renderSettings["pngColorMode"])
+                    outputDocument.write(pageFile, pageName + ".png")
+            finally:
+                if os.path.isfile(pageFile):
+                    os.remove(pageFile)
+    finally:
+        if (exportFormat["format"] == "pdf"):
+            outputDocument.saveAndClose()
+        else:
+            outputDocument.close()
+        del outputDocument
+        # Clean up - delete the map document reference
+        filePath = mxd.filePath
+        del mxd, result
+        os.remove(filePath)
+
+    deliverJobScratch(jobFolder)
+    atlasSeconds = time.time() - atlasStartTime
+    printMessage("Exported " + str(len(extents)) + " pages in " + str(round(atlasSeconds,3)) + " seconds (" + str(round(atlasSeconds / max(len(extents), 1),3)) + " seconds per page)...","info")
+    return outputFile
+# End of atlas function
+
+
+# Start of read atlas extents function
+def readAtlasExtents(extentsFile):
+    # If a CSV file - Header row of xmin,ymin,xmax,ymax and optionally scale and name
+    if extentsFile.lower().endswith(".csv"):
+        with open(extentsFile) as extentsContent:
+            return [extent for extent in csv.DictReader(extentsContent)]
+    # Else a JSON file - List of extents e.g. [{"xmin": 1, "ymin": 1, "xmax": 2, "ymax": 2, "scale": 1000, "name": "Sheet 1"}]
+    with open(extentsFile) as extentsContent:
+        return json.load(extentsContent)
+# End of read atlas extents function
+
+
 # Start of re-size element function
-def reSizeElement(mxd,elementType,height,width,X,Y):
+def reSizeElement(element,height,width,X,Y):
     # Resize element by setting the values below
-    element = arcpy.mapping.ListLayoutElements(mxd, elementType)[0]
     if (height):
         element.elementHeight = height
     if (width):
@@ -377,83 +2000,283 @@ def reSizeElement(mxd,elementType,height,width,X,Y):
 # End of re-size element function
 
 
+# Start of classify layers function
+def classifyLayers(mxd,df):
+    # Sort every layer in the data frame into service, vector, group and other layers (e.g. drawn graphics) in one pass
+    layerIndex = {"serviceLayers": [], "vectorLayers": [], "groupLayers": [], "otherLayers": [], "serviceLayersNames": set(), "vectorLayersNames": set(), "layerCount": 0}
+    for lyr in arcpy.mapping.ListLayers(mxd, data_frame=df):
+        layerIndex["layerCount"] = layerIndex["layerCount"] + 1
+        if lyr.isGroupLayer:
+            layerIndex["groupLayers"].append(lyr)
+        elif lyr.isServiceLayer:
+            layerIndex["serviceLayers"].append(lyr)
+            # Names of all visible service layers in the map
+            if lyr.visible:
+                layerIndex["serviceLayersNames"].add(lyr.name)
+        else:
+            # Names of all possible vector layers in the map that could have a corresponding service layer
+            layerIndex["vectorLayersNames"].add(lyr.name)
+            # Check if it's an other layer type i.e drawn graphics
+            if lyr.supports("serviceProperties") and (lyr.serviceProperties["ServiceType"].lower() == "other"):
+                layerIndex["otherLayers"].append(lyr)
+            else:
+                layerIndex["vectorLayers"].append(lyr)
+
+    # Get all service layers that do have a corresponding vector layer
+    removeServiceLayerNames = layerIndex["serviceLayersNames"] & layerIndex["vectorLayersNames"]
+    layerIndex["removeServiceLayers"] = [slyr for slyr in layerIndex["serviceLayers"]
+                                         if slyr.name in removeServiceLayerNames]
+    # Get all vector layers that don't have a corresponding service layer - Other layer types i.e drawn graphics are kept
+    layerIndex["removeVectorLayers"] = [vlyr for vlyr in layerIndex["vectorLayers"]
+                                        if vlyr.name not in layerIndex["serviceLayersNames"]]
+    return layerIndex
+# End of classify layers function
+
+
+# Start of load templates function
+def loadTemplates(layoutTemplatesFolder):
+    # Register the templates in the templates folder and dynamic legend folder - Layout information is read when a template is first used
+    for folder in [layoutTemplatesFolder, os.path.join(layoutTemplatesFolder, "Dynamic Legend")]:
+        if os.path.isdir(folder):
+            for fileName in os.listdir(folder):
+                if fileName.lower().endswith(".mxd"):
+                    templateMxd = os.path.normpath(os.path.join(folder, fileName))
+                    if templateMxd not in templateCache:
+                        templateCache[templateMxd] = {"mtime": os.path.getmtime(templateMxd), "info": None}
+    return templateCache
+# End of load templates function
+
+
+# Start of get template info function
+def getTemplateInfo(templateMxd,mxd,layoutElements):
+    # If the template has changed since it was cached, read the layout information again
+    mtime = os.path.getmtime(templateMxd)
+    if (templateMxd not in templateCache) or (templateCache[templateMxd]["mtime"] != mtime):
+        templateCache[templateMxd] = {"mtime": mtime, "info": None}
+
+    # If the layout information has not been read for this template
+    if (templateCache[templateMxd]["info"] is None):
+        # Get the layout information from the converted map document - This has the same layout as the template
+        templateInfo = {"legendName": None, "legendBorderHeight": None, "pageWidth": mxd.pageSize.width, "pageHeight": mxd.pageSize.height}
+        if (len(layoutElements["LEGEND_ELEMENT"]) > 0):
+            templateInfo["legendName"] = layoutElements["LEGEND_ELEMENT"][0].name
+        for element in layoutElements["GRAPHIC_ELEMENT"]:
+            # If there is a legend border element
+            if (element.name.lower() == "legend border"):
+                templateInfo["legendBorderHeight"] = element.elementHeight
+        templateCache[templateMxd]["info"] = templateInfo
+    return templateCache[templateMxd]["info"]
+# End of get template info function
+
+
+# Start of list layout elements function
+def listLayoutElements(mxd):
+    # Get all the layout elements in one call and group them by type
+    layoutElements = {"DATAFRAME_ELEMENT": [], "GRAPHIC_ELEMENT": [], "LEGEND_ELEMENT": [], "MAPSURROUND_ELEMENT": [], "PICTURE_ELEMENT": [], "TEXT_ELEMENT": []}
+    for element in arcpy.mapping.ListLayoutElements(mxd):
+        layoutElements.setdefault(element.type, []).append(element)
+    return layoutElements
+# End of list layout elements function
+
+
 # Start of create legend function
-def createLegend(mxd):
-    global dynLegendOverflow
-
-    # Create a copy of the MXD
-    copyMXD = 'Legend_{}.{}'.format(str(uuid.uuid1()), ".mxd")
-    mxd.saveACopy(copyMXD)
-    legendMXD = arcpy.mapping.MapDocument(copyMXD)
-
-    # Remove all data frame elements
-    for element in arcpy.mapping.ListLayoutElements(legendMXD, "DATAFRAME_ELEMENT"):
-        # Remove the data frame by moving it off the page
-        element.elementPositionX = -5000
-        element.elementPositionY = -5000
-    # Remove all text elements
-    for element in arcpy.mapping.ListLayoutElements(legendMXD, "TEXT_ELEMENT"):
-        # Remove the text by moving it off the page
-        element.elementPositionX = -5000
-        element.elementPositionY = -5000
-    # Remove all picture elements
-    for element in arcpy.mapping.ListLayoutElements(legendMXD, "PICTURE_ELEMENT"):
-        # Remove the picture by moving it off the page
-        element.elementPositionX = -5000
-        element.elementPositionY = -5000
-    # Remove all graphic elements
-    for element in arcpy.mapping.ListLayoutElements(legendMXD, "GRAPHIC_ELEMENT"):
-        # Remove the graphic by moving it off the page
-        element.elementPositionX = -5000
-        element.elementPositionY = -5000
-    # Remove all map surround elements
-    for element in arcpy.mapping.ListLayoutElements(legendMXD, "MAPSURROUND_ELEMENT"):
-        # Remove the map surround by moving it off the page
-        element.elementPositionX = -5000
-        element.elementPositionY = -5000
-
-    # Resize legend element by adding values - Height, width, X and Y
-    legend = arcpy.mapping.ListLayoutElements(legendMXD, "LEGEND_ELEMENT")[0]
-
-    # If it is a fixed legend
-    if not dynLegendOverflow:
-        height = legendMXD.pageSize.height-2 # Resize legend to whole page
-        width = legendMXD.pageSize.width-2 # Resize legend to whole page
-    # If it is a dynamic legend
-    else:
-        height = None # Keep legend the same size
-        width = None # Keep legend the same size
-
-        # If the legend is bigger than the page
-        legendColumns = 1
-        # While the legend is bigger than the page, keep adding columns
-        while ((legend.elementHeight/legendMXD.pageSize.height) > 0.95):
-            # Add another column to the legend
-            legendColumns = legendColumns + 1
-            legend.adjustColumnCount(legendColumns)
-
-    X = 1  # Move the legend to the top left corner of the page
-    Y = legendMXD.pageSize.height - 1 # Move the legend to the top left corner of the page
-    reSizeElement(legendMXD,"LEGEND_ELEMENT",height,width,X,Y)
-    # Use the uuid module to generate a GUID as part of the output name
-    # This will ensure a unique output name
-    output = 'Legend_{}.{}'.format(str(uuid.uuid1()), ".pdf")
-    outputFile = os.path.join(arcpy.env.scratchFolder, output)
+def createLegend(mxd,templateInfo,layoutElements,jobContext):
+    jobFolder = jobContext["jobFolder"]
+    legendStartTime = time.time()
+    stageTime = legendStartTime
 
-    ### Debugging ###
-##    legendMXD.saveACopy(r"C:\Temp\OutputLegend.mxd")
+    # Create the legend page from the open map document - Elements are moved off the page and put back once the legend is exported
+    movedElements = []
+    copyMXD = None
+    try:
+        # Remove all data frame, text, picture, graphic and map surround elements
+        for elementType in ["DATAFRAME_ELEMENT","TEXT_ELEMENT","PICTURE_ELEMENT","GRAPHIC_ELEMENT","MAPSURROUND_ELEMENT"]:
+            for element in layoutElements[elementType]:
+                movedElements.append((element, element.elementPositionX, element.elementPositionY))
+                # Remove the element by moving it off the page
+                element.elementPositionX = -5000
+                element.elementPositionY = -5000
 
-    # Export the WebMap
-    printMessage("Exporting legend to an output file...","info")
-    arcpy.mapping.ExportToPDF(legendMXD, outputFile)
-    return outputFile
+        # Resize legend element by adding values - Height, width, X and Y
+        legend = layoutElements["LEGEND_ELEMENT"][0]
+
+        # If it is a fixed legend
+        if not jobContext["legendOverflow"]:
+            height = templateInfo["pageHeight"]-2 # Resize legend to whole page
+            width = templateInfo["pageWidth"]-2 # Resize legend to whole page
+        # If it is a dynamic legend
+        else:
+            height = None # Keep legend the same size
+            width = None # Keep legend the same size
+
+            # If the legend is bigger than the page, add columns until it fits
+            legendPages = fitLegendColumns(legend,templateInfo["pageHeight"])
+            # If the legend doesn't fit on a page with the maximum number of columns
+            if (legendPages > 1):
+                # Save a copy with the elements moved off the page to create each legend page from
+                copyMXD = os.path.join(jobFolder, 'Legend_{}.{}'.format(str(uuid.uuid1()), "mxd"))
+                mxd.saveACopy(copyMXD)
+
+        X = 1  # Move the legend to the top left corner of the page
+        Y = templateInfo["pageHeight"] - 1 # Move the legend to the top left corner of the page
+        reSizeElement(legend,height,width,X,Y)
+        # Use the uuid module to generate a GUID as part of the output name
+        # This will ensure a unique output name
+        output = 'Legend_{}.{}'.format(str(uuid.uuid1()), "pdf")
+        outputFile = os.path.join(jobFolder, output)
+
+        ### Debugging ###
+##        mxd.saveACopy(r"C:\Temp\OutputLegend.mxd")
+
+        stageTime = timeStage(jobContext,"legendLayout",stageTime)
+
+        # Export the WebMap
+        printMessage("Exporting legend to an output file...","info")
+        # If the legend is split across pages
+        if (copyMXD):
+            outputFiles = createLegendPages(copyMXD,templateInfo,legendPages,jobFolder)
+        else:
+            arcpy.mapping.ExportToPDF(mxd, outputFile)
+            outputFiles = [outputFile]
+        timeStage(jobContext,"legendExport",stageTime)
+    finally:
+        # Put the elements back on the page - The legend itself is moved off the page for the map once the legend page is created
+        for element, X, Y in movedElements:
+            element.elementPositionX = X
+            element.elementPositionY = Y
+        # Clean up - delete the legend map document
+        if (copyMXD) and (os.path.isfile(copyMXD)):
+            os.remove(copyMXD)
+
+    printMessage("Created " + str(len(outputFiles)) + " legend page(s) in " + str(round(time.time() - legendStartTime,3)) + " seconds...","info")
+    return outputFiles
 # End of create legend function
 
 
+# Start of fit legend columns function
+def fitLegendColumns(legend,pageHeight):
+    # The legend fits when it is no more than 95% of the page height
+    maxHeight = pageHeight * 0.95
+    legendHeight = legend.elementHeight
+    # If the legend already fits on the page
+    if (legendHeight <= maxHeight):
+        return 1
+
+    # Estimate the number of columns needed from the height of the legend in one column, then binary search either side of this
+    lowColumns = 2
+    highColumns = max(int(legendMaxColumns), lowColumns)
+    legendColumns = min(max(int(math.ceil(legendHeight / maxHeight)), lowColumns), highColumns)
+    fittedColumns = None
+    while (lowColumns <= highColumns):
+        legend.adjustColumnCount(legendColumns)
+        adjustedColumns = legendColumns
+        # If the legend fits, try fewer columns
+        if (legend.elementHeight <= maxHeight):
+            fittedColumns = legendColumns
+            highColumns = legendColumns - 1
+        # Else try more columns
+        else:
+            lowColumns = legendColumns + 1
+        legendColumns = (lowColumns + highColumns) // 2
+
+    # If the legend fits, make sure it is set to the fewest columns that fit
+    if (fittedColumns):
+        if (fittedColumns != adjustedColumns):
+            legend.adjustColumnCount(fittedColumns)
+        return 1
+    # Else get the number of pages needed with the maximum number of columns
+    legend.adjustColumnCount(max(int(legendMaxColumns), 2))
+    return int(math.ceil(legend.elementHeight / maxHeight))
+# End of fit legend columns function
+
+
+# Start of create legend pages function
+def createLegendPages(copyMXD,templateInfo,legendPages,jobFolder):
+    outputFiles = []
+    legendItemCount = None
+    for page in range(legendPages):
+        # Open the legend map document and get the legend items for this page
+        legendMXD = arcpy.mapping.MapDocument(copyMXD)
+        legend = arcpy.mapping.ListLayoutElements(legendMXD, "LEGEND_ELEMENT")[0]
+        legendItems = legend.listLegendItemLayers()
+        if (legendItemCount is None):
+            legendItemCount = len(legendItems)
+        pageItemCount = int(math.ceil(float(legendItemCount) / legendPages))
+
+        # Remove the legend items that are on the other pages
+        for index in range(len(legendItems)):
+            if (index < page * pageItemCount) or (index >= (page + 1) * pageItemCount):
+                legend.removeItem(legendItems[index])
+        legend.adjustColumnCount(1)
+        fitLegendColumns(legend,templateInfo["pageHeight"])
+
+        # Move the legend to the top left corner of the page and export
+        reSizeElement(legend,None,None,1,templateInfo["pageHeight"] - 1)
+        outputFile = os.path.join(jobFolder, 'Legend_{}.{}'.format(str(uuid.uuid1()), "pdf"))
+        arcpy.mapping.ExportToPDF(legendMXD, outputFile)
+        outputFiles.append(outputFile)
+        del legendMXD
+    return outputFiles
+# End of create legend pages function
+
+
+# Start of assemble PDF function
+def assemblePDF(outputFile,pagePDFs):
+    # Get the size of the map PDF and the pages being added to it
+    pdfStats = {"pages": len(pagePDFs) + 1, "mapBytes": os.path.getsize(outputFile), "pageBytes": 0}
+    for pagePDF in pagePDFs:
+        pdfStats["pageBytes"] = pdfStats["pageBytes"] + os.path.getsize(pagePDF)
+
+    # Append the pages to the map PDF in place rather than copying the map into a new PDF
+    outputPDF = arcpy.mapping.PDFDocumentOpen(outputFile)
+    for pagePDF in pagePDFs:
+        outputPDF.appendPages(pagePDF)
+    outputPDF.saveAndClose()
+    del outputPDF
+
+    # Bytes written for the job are the map, the pages and the final PDF - The map PDF is replaced by the final PDF so peak disk usage is the pages plus the final PDF
+    pdfStats["outputBytes"] = os.path.getsize(outputFile)
+    pdfStats["bytesWritten"] = pdfStats["mapBytes"] + pdfStats["pageBytes"] + pdfStats["outputBytes"]
+    pdfStats["peakBytes"] = pdfStats["pageBytes"] + max(pdfStats["mapBytes"], pdfStats["outputBytes"])
+    printMessage("Created " + str(pdfStats["pages"]) + " page PDF - " + str(pdfStats["bytesWritten"]) + " bytes written, " + str(pdfStats["peakBytes"]) + " bytes peak disk usage...","info")
+    return pdfStats
+# End of assemble PDF function
+
+
+# Start of get error message function
+def getErrorMessage(e):
+    errorMessage = ""
+    # Build the error message
+    # If many arguments
+    if (e.args):
+        for i in range(len(e.args)):
+            if (i == 0):
+                # Python version check
+                if sys.version_info[0] >= 3:
+                    # Python 3.x
+                    errorMessage = str(e.args[i]).encode('utf-8').decode('utf-8')
+                else:
+                    # Python 2.x
+                    errorMessage = unicode(e.args[i]).encode('utf-8')
+            else:
+                # Python version check
+                if sys.version_info[0] >= 3:
+                    # Python 3.x
+                    errorMessage = errorMessage + " " + str(e.args[i]).encode('utf-8').decode('utf-8')
+                else:
+                    # Python 2.x
+                    errorMessage = errorMessage + " " + unicode(e.args[i]).encode('utf-8')
+    # Else just one argument
+    else:
+        errorMessage = e
+    return errorMessage
+# End of get error message function
+
+
 # Start of print message function
 def printMessage(message,type):
-    # If ArcGIS desktop installed
-    if (arcgisDesktop == "true"):
+    # If ArcGIS desktop installed and arcpy has been imported
+    if (arcgisDesktop == "true") and (arcpy is not None):
         if (type.lower() == "warning"):
             arcpy.AddWarning(message)
         elif (type.lower() == "error"):
@@ -468,6 +2291,7 @@ def printMessage(message,type):
 
 # Start of set logging function
 def setLogging(logFile):
+    import logging
     # Create a logger
     logger = logging.getLogger(os.path.basename(__file__))
     logger.setLevel(logging.DEBUG)
@@ -484,25 +2308,164 @@ def setLogging(logFile):
 # End of set logging function
 
 
+# Start of queue email function
+def queueEmail(message):
+    # Add the error to the emails sent in the background so jobs don't wait on the email server
+    with emailLock:
+        if (emailState["thread"] is None):
+            emailState["queue"] = Queue.Queue(int(emailQueueSize))
+            emailState["thread"] = threading.Thread(target=runEmailWorker, args=(emailState["queue"],))
+            emailState["thread"].daemon = True
+            emailState["thread"].start()
+            # Send any errors waiting when the script finishes
+            atexit.register(stopEmailWorker)
+        emailStats["queued"] = emailStats["queued"] + 1
+    try:
+        emailState["queue"].put_nowait(message)
+    # If the email server can't keep up, count the error rather than holding up the job
+    except Queue.Full:
+        with emailLock:
+            emailState["dropped"] = emailState["dropped"] + 1
+# End of queue email function
+
+
+# Start of run email worker function
+def runEmailWorker(emailQueue):
+    # Collect the errors and send them as a digest at most once every digest interval
+    pendingErrors = collections.OrderedDict()
+    while True:
+        # Wait for the next error, until the next digest is due or until the connection has been idle too long
+        if (pendingErrors):
+            waitTime = max(emailState["lastSent"] + float(emailDigestInterval) - time.time(), 0.01)
+        else:
+            waitTime = float(emailConnectionIdle)
+        try:
+            message = emailQueue.get(True, waitTime)
+        except Queue.Empty:
+            message = ""
+        # If the script is finishing, send the errors waiting and close the connection
+        if (message is None):
+            while not emailQueue.empty():
+                addEmailError(pendingErrors,emailQueue.get())
+            sendDigest(pendingErrors)
+            closeEmailConnection()
+            return
+        if (message):
+            addEmailError(pendingErrors,message)
+        if (pendingErrors) and (time.time() - emailState["lastSent"] >= float(emailDigestInterval)):
+            sendDigest(pendingErrors)
+        elif (emailState["connection"]) and (time.time() - emailState["lastUsed"] >= float(emailConnectionIdle)):
+            closeEmailConnection()
+# End of run email worker function
+
+
+# Start of add email error function
+def addEmailError(pendingErrors,message):
+    # Count repeated errors rather than sending them again
+    pendingError = pendingErrors.setdefault(message, {"count": 0, "firstTime": time.time()})
+    pendingError["count"] = pendingError["count"] + 1
+    pendingError["lastTime"] = time.time()
+# End of add email error function
+
+
+# Start of send digest function
+def sendDigest(pendingErrors):
+    with emailLock:
+        droppedErrors = emailState["dropped"]
+        emailState["dropped"] = 0
+    if not (pendingErrors) and not (droppedErrors):
+        return
+    # One error is sent as it is, more than one is sent as a digest
+    errorCount = sum([pendingErrors[message]["count"] for message in pendingErrors]) + droppedErrors
+    if (errorCount == 1):
+        message = list(pendingErrors.keys())[0]
+    else:
+        messages = []
+        for errorMessage in pendingErrors:
+            pendingError = pendingErrors[errorMessage]
+            messages.append(str(pendingError["count"]) + " x (" + time.strftime("%H:%M:%S", time.localtime(pendingError["firstTime"])) + " to " + time.strftime("%H:%M:%S", time.localtime(pendingError["lastTime"])) + ") - " + errorMessage)
+        if (droppedErrors):
+            messages.append(str(droppedErrors) + " x errors not kept as too many errors were waiting to be emailed")
+        message = str(errorCount) + " errors since the last email:\n\n" + "\n\n".join(messages)
+    try:
+        sendEmail(message)
+    except Exception as e:
+        emailStats["failed"] = emailStats["failed"] + 1
+        printMessage("Email could not be sent - " + str(getErrorMessage(e)),"warning")
+    pendingErrors.clear()
+    emailState["lastSent"] = time.time()
+# End of send digest function
+
+
 # Start of send email function
 def sendEmail(message):
+    import smtplib
     # Send an email
     printMessage("Sending email...","info")
-    # Server and port information
-    smtpServer = smtplib.SMTP(emailServerName,emailServerPort)
-    smtpServer.ehlo()
-    smtpServer.starttls()
-    smtpServer.ehlo
-    # Login with sender email address and password
-    smtpServer.login(emailUser, emailPassword)
     # Email content
     header = 'To:' + emailTo + '\n' + 'From: ' + emailUser + '\n' + 'Subject:' + emailSubject + '\n'
     body = header + '\n' + emailMessage + '\n' + '\n' + message
-    # Send the email and close the connection
-    smtpServer.sendmail(emailUser, emailTo, body)
+    # Send the email on the open connection - If the server has closed it, send it again on a new connection
+    for attempt in range(2):
+        smtpServer = getEmailConnection()
+        try:
+            smtpServer.sendmail(emailUser, emailTo, body)
+            break
+        except smtplib.SMTPServerDisconnected:
+            closeEmailConnection()
+            if (attempt == 1):
+                raise
+    emailState["lastUsed"] = time.time()
+    emailStats["emails"] = emailStats["emails"] + 1
 # End of send email function
 
 
+# Start of get email connection function
+def getEmailConnection():
+    import smtplib
+    # Use the open connection to the email server if there is one
+    if (emailState["connection"]):
+        return emailState["connection"]
+    # Server and port information
+    smtpServer = smtplib.SMTP(emailServerName,emailServerPort,timeout=60)
+    smtpServer.ehlo()
+    if smtpServer.has_extn("starttls"):
+        smtpServer.starttls()
+        smtpServer.ehlo()
+    # Login with sender email address and password
+    if (emailPassword):
+        smtpServer.login(emailUser, emailPassword)
+    emailState["connection"] = smtpServer
+    emailStats["connections"] = emailStats["connections"] + 1
+    return smtpServer
+# End of get email connection function
+
+
+# Start of close email connection function
+def closeEmailConnection():
+    # Close the connection to the email server
+    if (emailState["connection"]):
+        try:
+            emailState["connection"].quit()
+        # The server may have already closed the connection
+        except Exception:
+            emailState["connection"].close()
+        emailState["connection"] = None
+# End of close email connection function
+
+
+# Start of stop email worker function
+def stopEmailWorker():
+    # Send the errors waiting to be emailed and wait for them to be sent
+    with emailLock:
+        emailThread = emailState["thread"]
+        emailState["thread"] = None
+    if (emailThread):
+        emailState["queue"].put(None)
+        emailThread.join(60)
+# End of stop email worker function
+
+
 # This test allows the script to be used from the operating
 # system command prompt (stand-alone), in a Python IDE,
 # as a geoprocessing script tool, or as a module imported in
@@ -512,8 +2475,12 @@ if __name__ == '__main__':
     if ((os.path.basename(sys.executable).lower() == "arcgispro.exe") or (os.path.basename(sys.executable).lower() == "arcmap.exe") or (os.path.basename(sys.executable).lower() == "arccatalog.exe")):
         arcgisDesktop = "true"
 
+    # If running a preflight check - arcpy is not needed so use the command line arguments
+    if (len(sys.argv) > 1) and (sys.argv[1] == "preflight"):
+        argv = sys.argv[1:]
     # If ArcGIS desktop installed
-    if (arcgisDesktop == "true"):
+    elif (arcgisDesktop == "true"):
+        importArcpy()
         argv = tuple(arcpy.GetParameterAsText(i)
             for i in range(arcpy.GetArgumentCount()))
     # ArcGIS desktop not installed
@@ -527,11 +2494,23 @@ if __name__ == '__main__':
         logger, logMessage = setLogging(logFile)
         # Log start of process
         logger.info("Process started.")
+    # Start the tile cache for requests made while converting web maps
+    if (enableTileCache == "true"):
+        startTileCache()
     # Setup the use of a proxy for requests
-    if (enableProxy == "true"):
-        # Setup the proxy
-        proxy = urllib2.ProxyHandler({requestProtocol : proxyURL})
-        openURL = urllib2.build_opener(proxy)
-        # Install the proxy
-        urllib2.install_opener(openURL)
-    mainFunction(*argv)
\ No newline at end of file
+    if (enableProxy == "true") or (enableTileCache == "true"):
+        installProxy()
+    # If running a batch of web maps e.g. ExportWebMap.py batch <JSON lines file or folder> <connection> <templates folder> <template> <format> <manifest>
+    if (len(argv) > 0) and (argv[0] == "batch"):
+        batchFunction(*argv[1:])
+    # If exporting a web map at many extents e.g. ExportWebMap.py atlas <web map JSON> <connection> <templates folder> <template> <extents file> <format> <output file>
+    elif (len(argv) > 0) and (argv[0] == "atlas"):
+        atlasFunction(*argv[1:])
+    # If checking a web map without exporting it e.g. ExportWebMap.py preflight <web map JSON or file> <templates folder> <template> <format>
+    elif (len(argv) > 0) and (argv[0] == "preflight"):
+        print(json.dumps(preflightFunction(*argv[1:]), indent=2))
+    # If running the print service e.g. ExportWebMap.py service <connection> <templates folder>
+    elif (len(argv) > 0) and (argv[0] == "service"):
+        serviceFunction(*argv[1:])
+    else:
+        mainFunction(*argv)
\ No newline at end of file